@@ -0,0 +1,547 @@
+"""
+Асинхронный клиент REST-API Kommo (amoCRM) на aiohttp.
+
+• Один долгоживущий `ClientSession` с пулом keep-alive соединений:
+  TLS-рукопожатие делается один раз, а не на каждую страницу
+• Все методы — корутины, поэтому загрузка этапа не блокирует event loop бота
+• Постраничные списки качаются окном из нескольких страниц одновременно
+• Все запросы делят общий бюджет параллельности (`max_concurrency`)
+• Общий на аккаунт token-bucket лимитер и повторы на 429/5xx
+  с учётом `Retry-After` и экспоненциальной задержкой с джиттером
+• Рабочий домен, данные аккаунта и списки воронок/этапов кэшируются
+  в памяти и в зеркале (`meta`), поэтому старт и обновление этапов
+  обходятся без проб `/account`
+• Нормализация телефонов мемоизирована, а российские мобильные
+  приводятся к E.164 без разбора libphonenumber
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from typing import Iterable
+
+import aiohttp
+import phonenumbers
+
+CONF_FILE = Path(__file__).parent / "conf.json"
+
+logger = logging.getLogger(__name__)
+
+# Системные этапы, которые не показываем как аудитории
+SYSTEM_STAGES = ("Неразобранное", "Успешно реализовано", "Закрыто и не реализовано")
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+    Token bucket: в среднем не больше `rate` запросов в секунду,
+    всплеск — до `burst` запросов подряд.
+    `pause()` останавливает выдачу токенов всем ожидающим (ответ 429).
+    """
+
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Ждёт, пока в ведре появится токен, и забирает его."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие `seconds` секунд."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+
+# Один лимитер на аккаунт: его делят все клиенты с тем же поддоменом
+_LIMITERS: dict[str, RateLimiter] = {}
+
+
+def _retry_after_seconds(value: str | None) -> float | None:
+    """Значение заголовка Retry-After (секунды или HTTP-дата) в секундах."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_NON_DIGITS = re.compile(r"\D")
+
+# Сколько разных «сырых» строк телефона помнит нормализатор
+PHONE_CACHE_SIZE = 200_000
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _normalize_phone(phone: str) -> str | bool:
+    digits = _NON_DIGITS.sub("", phone)
+    # Быстрый путь: мобильный РФ (+7 9XX…) — весь диапазон 9XX валиден
+    # в libphonenumber, и E.164 для него — это просто «+7» и 10 цифр
+    if digits.isascii():
+        if len(digits) == 10 and digits[0] == "9":
+            return "+7" + digits
+        if len(digits) == 11 and digits[0] in "78" and digits[1] == "9":
+            return "+7" + digits[1:]
+    if digits.startswith("8") and len(digits) == 11:
+        digits = "7" + digits[1:]
+    elif digits.startswith("7") and len(digits) == 11:
+        pass
+    elif digits.startswith("9") and len(digits) == 10:
+        digits = "7" + digits
+    digits = "+" + digits
+    try:
+        parsed = phonenumbers.parse(digits, None)
+        if phonenumbers.is_valid_number(parsed):
+            return phonenumbers.format_number(
+                parsed, phonenumbers.PhoneNumberFormat.E164
+            )
+    except phonenumbers.phonenumberutil.NumberParseException:
+        pass
+    return False
+
+
+class AmoCRMClient:
+    """
+    Обёртка над REST-API Kommo (amoCRM) с общим пулом соединений.
+
+    Использование:
+        async with AmoCRMClient() as mgr:
+            leads = await mgr.get_leads(pipeline_id, status_id)
+    или долгоживущий экземпляр: `await mgr.start()` … `await mgr.close()`.
+    """
+
+    def __init__(
+        self,
+        cfg: dict | None = None,
+        *,
+        pool_size: int = 8,
+        timeout: float = 20,
+        page_concurrency: int | None = None,
+        max_concurrency: int | None = None,
+        max_retries: int = 5,
+        contact_cache=None,
+        store=None,
+    ) -> None:
+        """
+        `cfg` — секция `amocrm` из conf.json (по умолчанию читается с диска).
+        `page_concurrency` — сколько страниц списка качать одновременно
+        (по умолчанию `cfg["page_concurrency"]` или 4).
+        `max_concurrency` — общий лимит одновременных запросов клиента
+        (по умолчанию `cfg["max_concurrency"]` или `pool_size`).
+        Лимит запросов в секунду на аккаунт — `cfg["rate_limit"]` (по умолчанию 7,
+        это ограничение amoCRM для одной интеграции).
+        `contact_cache` — crm_store.ContactCache: `get_contacts_bulk` качает
+        только отсутствующие или устаревшие в нём контакты.
+        `store` — crm_store.CRMStore: туда сохраняются рабочий домен, данные
+        аккаунта и списки воронок/этапов. Домен перепроверяется раз в
+        `cfg["domain_ttl"]` секунд (по умолчанию сутки), списки воронок и этапов —
+        раз в `cfg["metadata_ttl"]` секунд (по умолчанию 10 минут).
+        `cfg["base_url"]` — явный адрес API вместо `{subdomain}.amocrm.ru|kommo.com`.
+        """
+        if cfg is None:
+            cfg = json.loads(CONF_FILE.read_text(encoding="utf-8"))["amocrm"]
+        self.page_concurrency: int = max(
+            1, page_concurrency or int(cfg.get("page_concurrency", 4))
+        )
+        self.subdomain: str = cfg["subdomain"]
+        self.access_token: str = cfg["access_token"]
+        if cfg.get("base_url"):
+            # Явный адрес API (прокси или локальный fake_amocrm.py) — без проб доменов
+            self._base_urls = [cfg["base_url"].rstrip("/")]
+        else:
+            self._base_urls = [
+                f"https://{self.subdomain}.amocrm.ru/api/v4",
+                f"https://{self.subdomain}.kommo.com/api/v4",
+            ]
+        self.headers = {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json",
+        }
+        self.base_url: str | None = None
+        self._pool_size = pool_size
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+        self.max_concurrency: int = max(
+            1, max_concurrency or int(cfg.get("max_concurrency", pool_size))
+        )
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self.max_retries = max_retries
+        self.contact_cache = contact_cache
+        self.store = store
+        self.account: dict | None = None
+        self.domain_ttl = float(cfg.get("domain_ttl", 24 * 3600))
+        self.metadata_ttl = float(cfg.get("metadata_ttl", 600))
+        self._metadata: dict[str, tuple[float, list]] = {}
+        self._limiter = _LIMITERS.setdefault(
+            self.subdomain, RateLimiter(float(cfg.get("rate_limit", 7)))
+        )
+
+    # ------------------------------------------------------------------
+    # Жизненный цикл
+    async def start(self) -> "AmoCRMClient":
+        """Создаёт сессию (если её нет) и определяет рабочий домен."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_size,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=self._timeout,
+            )
+        if self.base_url is None:
+            self.base_url = self._cached_base_url() or await self._detect_base_url()
+        return self
+
+    async def close(self) -> None:
+        """Закрывает сессию и все keep-alive соединения."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self) -> "AmoCRMClient":
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    def _cached_base_url(self) -> str | None:
+        """Домен из зеркала, если он определялся не раньше `domain_ttl` назад."""
+        if self.store is None:
+            return None
+        raw = self.store.get_meta(f"account:{self.subdomain}")
+        if not raw:
+            return None
+        cached = json.loads(raw)
+        if time.time() - cached["at"] > self.domain_ttl or cached["url"] not in self._base_urls:
+            return None
+        self.account = cached["account"]
+        return cached["url"]
+
+    async def _detect_base_url(self) -> str:
+        """Возвращает первый API-домен, который отвечает 200 на `/account`."""
+        for url in self._base_urls:
+            try:
+                async with self._session.get(
+                    f"{url}/account", timeout=aiohttp.ClientTimeout(total=6)
+                ) as r:
+                    if r.status == 200:
+                        self.account = await r.json(content_type=None)
+                        if self.store is not None:
+                            self.store.set_meta(
+                                f"account:{self.subdomain}",
+                                json.dumps(
+                                    {"url": url, "account": self.account, "at": time.time()},
+                                    ensure_ascii=False,
+                                ),
+                            )
+                        return url
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        raise RuntimeError("Не удалось найти рабочий домен Kommo")
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: float | None = None) -> float:
+        """Пауза перед повтором: Retry-After или 0.5·2^attempt с полным джиттером."""
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 0.5)
+        return random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
+    async def _get(self, path: str, params: dict | None = None) -> tuple[int, dict | None]:
+        """
+        GET к API: (HTTP-статус, JSON или None для 204).
+
+        Каждый запрос берёт токен у общего лимитера. 429/5xx и сетевые
+        ошибки повторяются до `max_retries` раз, после чего — исключение.
+        """
+        if self._session is None or self.base_url is None:
+            await self.start()
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            await self._limiter.acquire()
+            try:
+                async with self._slots:
+                    async with self._session.get(url, params=params) as r:
+                        if r.status == 204:
+                            return 204, None
+                        if r.status not in RETRY_STATUSES or attempt == self.max_retries:
+                            r.raise_for_status()
+                            return r.status, await r.json(content_type=None)
+                        delay = self._backoff(
+                            attempt, _retry_after_seconds(r.headers.get("Retry-After"))
+                        )
+                        if r.status == 429:
+                            self._limiter.pause(delay)
+                        logger.warning(
+                            "amoCRM %s ответил %s, повтор %d/%d через %.1f с",
+                            path, r.status, attempt + 1, self.max_retries, delay,
+                        )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(
+                    "amoCRM %s: сетевая ошибка %r, повтор %d/%d через %.1f с",
+                    path, e, attempt + 1, self.max_retries, delay,
+                )
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _fetch_page(
+        self, path: str, params: dict, key: str, page: int, limit: int
+    ) -> list[dict]:
+        """Одна страница списка `_embedded[key]`; пустой список — конец выдачи."""
+        status, data = await self._get(path, {**params, "limit": limit, "page": page})
+        if status == 204 or not data:
+            return []
+        return data.get("_embedded", {}).get(key) or []
+
+    async def iter_pages(
+        self, path: str, params: dict, key: str, limit: int = 250
+    ):
+        """
+        Асинхронный итератор страниц списка в порядке page=1,2,3…
+
+        Держит в полёте до `page_concurrency` запросов: пока обрабатывается
+        страница N, следующие уже качаются. Останавливается на первой
+        пустой/204 или неполной странице, лишние запросы отменяет.
+        """
+        tasks: dict[int, asyncio.Task] = {}
+        next_page = current = 1
+        try:
+            while True:
+                while len(tasks) < self.page_concurrency:
+                    tasks[next_page] = asyncio.create_task(
+                        self._fetch_page(path, params, key, next_page, limit)
+                    )
+                    next_page += 1
+                batch = await tasks.pop(current)
+                if not batch:
+                    break
+                yield batch
+                if len(batch) < limit:
+                    break
+                current += 1
+        finally:
+            for t in tasks.values():
+                t.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    # ------------------------------------------------------------------
+    # Воронки и этапы
+    def _metadata_get(self, key: str) -> list | None:
+        """Список из кэша (память, затем зеркало), если он не старше `metadata_ttl`."""
+        entry = self._metadata.get(key)
+        if entry is None and self.store is not None:
+            raw = self.store.get_meta(f"metadata:{self.subdomain}:{key}")
+            if raw:
+                cached = json.loads(raw)
+                entry = self._metadata[key] = (cached["at"], cached["items"])
+        if entry is None or time.time() - entry[0] > self.metadata_ttl:
+            return None
+        return entry[1]
+
+    def _metadata_put(self, key: str, items: list) -> None:
+        now = time.time()
+        self._metadata[key] = (now, items)
+        if self.store is not None:
+            self.store.set_meta(
+                f"metadata:{self.subdomain}:{key}",
+                json.dumps({"at": now, "items": items}, ensure_ascii=False),
+            )
+
+    async def get_pipelines(self, *, force: bool = False) -> list[tuple[int, str]]:
+        """Список воронок: [(id, name), …]; `force` — мимо кэша."""
+        items = None if force else self._metadata_get("pipelines")
+        if items is None:
+            _, data = await self._get("/leads/pipelines")
+            items = [[p["id"], p["name"]] for p in data["_embedded"]["pipelines"]]
+            self._metadata_put("pipelines", items)
+        return [(pid, name) for pid, name in items]
+
+    async def get_pipeline_statuses(
+        self, pipeline_id: int, skip_system: bool = False, *, force: bool = False
+    ) -> list[tuple[int, str]]:
+        """
+        Этапы воронки: [(id, name), …]; `skip_system` убирает системные этапы,
+        `force` — мимо кэша.
+        """
+        key = f"statuses:{pipeline_id}"
+        items = None if force else self._metadata_get(key)
+        if items is None:
+            _, data = await self._get(f"/leads/pipelines/{pipeline_id}/statuses")
+            items = [[s["id"], s["name"]] for s in data["_embedded"]["statuses"]]
+            self._metadata_put(key, items)
+        return [
+            (sid, name)
+            for sid, name in items
+            if not (skip_system and name in SYSTEM_STAGES)
+        ]
+
+    # ------------------------------------------------------------------
+    # Сделки и контакты
+    async def get_leads(self, pipeline_id: int, status_id: int) -> list[dict]:
+        """Все сделки этапа; у каждой сделки есть вложенный список id контактов."""
+        out: list[dict] = []
+        async for batch in self.iter_lead_pages(pipeline_id, status_id):
+            out.extend(batch)
+        return out
+
+    def iter_lead_pages(self, pipeline_id: int, status_id: int):
+        """Страницы сделок этапа (по 250) в исходном порядке."""
+        return self.iter_stages_lead_pages(pipeline_id, [status_id])
+
+    def iter_stages_lead_pages(
+        self, pipeline_id: int, status_ids: list[int], extra: dict | None = None
+    ):
+        """
+        Страницы сделок нескольких этапов воронки одним запросом `filter[statuses]`.
+        `extra` — дополнительные фильтры (crm_filters.AudienceFilter.to_params()).
+        """
+        params: dict = {"with": "contacts", **(extra or {})}
+        for i, sid in enumerate(status_ids):
+            params[f"filter[statuses][{i}][pipeline_id]"] = pipeline_id
+            params[f"filter[statuses][{i}][status_id]"] = sid
+        return self.iter_pages("/leads", params, "leads")
+
+    async def get_leads_by_ids(self, ids: list[int]) -> list[dict]:
+        """Сделки по списку id (с контактами); удалённые просто не вернутся."""
+        out: list[dict] = []
+        ids_iter = iter(ids)
+        while chunk := list(islice(ids_iter, 250)):
+            params = {"with": "contacts"}
+            params.update({f"filter[id][{i}]": lid for i, lid in enumerate(chunk)})
+            async for batch in self.iter_pages("/leads", params, "leads"):
+                out.extend(batch)
+        return out
+
+    async def iter_updated_lead_pages(self, since: int, limit: int = 250):
+        """
+        Страницы сделок аккаунта, изменённых начиная с unix-времени `since`,
+        по возрастанию updated_at.
+
+        Листается по ключу, а не page=N: следующая страница запрашивается
+        с `filter[updated_at][from]` = последнему увиденному updated_at.
+        Сделка, изменённая во время обхода, уходит в хвост выдачи и не сдвигает
+        ещё не прочитанные. Уже отданные сделки с тем же updated_at
+        отбрасываются по id. Только если целая страница имеет одно updated_at,
+        внутри него листаем по номеру страницы.
+        """
+        cursor, page = since, 1
+        at_cursor: set[int] = set()  # id уже отданных сделок с updated_at == cursor
+        while True:
+            params = {
+                "filter[updated_at][from]": cursor,
+                "order[updated_at]": "asc",
+                "with": "contacts",
+            }
+            batch = await self._fetch_page("/leads", params, "leads", page, limit)
+            fresh = [
+                l for l in batch
+                if not (l.get("updated_at") == cursor and l["id"] in at_cursor)
+            ]
+            if fresh:
+                yield fresh
+            if len(batch) < limit:
+                return
+            last = max(l.get("updated_at") or 0 for l in batch)
+            if last == cursor:
+                page += 1
+                at_cursor.update(l["id"] for l in batch)
+            else:
+                cursor, page = last, 1
+                at_cursor = {l["id"] for l in batch if l.get("updated_at") == last}
+
+    async def get_contacts_bulk(self, ids: list[int]) -> dict[int, dict]:
+        """
+        Словарь контактов {id: объект}. Запрашивает пачками по 200 id.
+        Пачка, которую не удалось получить и после повторов, — исключение,
+        а не молча потерянные контакты.
+        """
+        result: dict[int, dict] = {}
+        if self.contact_cache is not None:
+            result, ids = self.contact_cache.get_many(ids)
+        fetched: list[dict] = []
+        ids_iter = iter(ids)
+        while chunk := list(islice(ids_iter, 200)):
+            params = {"with": "custom_fields_values"}
+            params.update({f"id[{i}]": cid for i, cid in enumerate(chunk)})
+            status, data = await self._get("/contacts", params)
+            if status == 204:
+                continue
+            fetched.extend(data["_embedded"]["contacts"])
+        for c in fetched:
+            result[c["id"]] = c
+        if self.contact_cache is not None:
+            self.contact_cache.put_many(fetched)
+        return result
+
+    # ------------------------------------------------------------------
+    # Телефоны
+    @staticmethod
+    def extract_phone(cfv: list[dict]) -> str:
+        """Возвращает первый телефон из custom_fields_values контакта."""
+        for fld in cfv or []:
+            if fld.get("field_code") == "PHONE":
+                for val in fld.get("values", []):
+                    phone = str(val.get("value", "")).strip()
+                    if phone:
+                        return phone
+        return ""
+
+    @staticmethod
+    def normalize_phone(phone: str):
+        """Приводит телефон к E.164 (+79991234567) или возвращает False."""
+        return _normalize_phone(phone or "")
+
+    @staticmethod
+    def normalize_many(phones: Iterable[str]) -> list[str | bool]:
+        """
+        `normalize_phone` для пачки телефонов (в том же порядке).
+        Повторы внутри пачки разбираются один раз.
+        """
+        done: dict[str, str | bool] = {}
+        out = []
+        for phone in phones:
+            phone = phone or ""
+            res = done.get(phone)
+            if res is None:
+                res = done[phone] = _normalize_phone(phone)
+            out.append(res)
+        return out
@@ -0,0 +1,380 @@
+"""
+Бенчмарк загрузки из amoCRM на фейковом сервере (fake_amocrm.py).
+
+Для каждого размера этапа поднимается отдельный fake_amocrm.py, а каждый
+сценарий выполняется в своём процессе — так пиковый RSS относится к нему одному:
+• get_leads               — AmoCRMClient.get_leads по этапу
+• get_contacts_bulk       — AmoCRMClient.get_contacts_bulk по всем контактам этапа
+• build_funnels_snapshot  — main.build_funnels_snapshot (funnels.json во временной папке)
+• cb_audience             — путь кнопки этапа в боте: StageSync.sync_stage
+                            в пустое зеркало + временный JSON аудитории
+
+    python bench_crm.py --sizes 1000,10000,100000 --latency 0.05 --rate-limit 7
+
+Запросы считает сам сервер (вместе с повторами после 429).
+
+Отдельно — нормализация телефонов (без сервера): прежний `normalize_phone`
+без кэша против `AmoCRMClient.normalize_many` на холодном и тёплом кэше:
+
+    python bench_crm.py phones --count 100000
+
+Проверка админа на каждом апдейте: сколько апдейтов в секунду проходит
+через aiogram Dispatcher с хендлером под проверкой, как в admin_required, —
+прежнее чтение admins.json против SQLiteStore.read() и `user_id in store`:
+
+    python bench_crm.py router --updates 20000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import phonenumbers
+
+from fake_amocrm import FakeAmoCRM
+
+BASE_DIR = Path(__file__).parent
+SCENARIOS = ("get_leads", "get_contacts_bulk", "build_funnels_snapshot", "cb_audience")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss на Linux — в килобайтах, на macOS — в байтах
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+async def run_scenario(scenario: str, size: int, url: str, rate_limit: float) -> dict:
+    """Один сценарий в текущем процессе: {"leads", "items", "seconds", "rss_mb"}."""
+    from amocrm_client import AmoCRMClient
+    from crm_store import CRMStore
+    from crm_sync import StageSync
+    from main import build_funnels_snapshot
+
+    fake = FakeAmoCRM((size,))
+    stage = fake.work_stages()[0]
+    cfg = {
+        "subdomain": "fake",
+        "access_token": fake.token,
+        "base_url": url,
+        "rate_limit": rate_limit,
+    }
+    tmp = Path(tempfile.mkdtemp(prefix="bench_crm_"))
+    leads = size
+    async with AmoCRMClient(cfg) as client:
+        started = time.perf_counter()
+        if scenario == "get_leads":
+            items = len(await client.get_leads(stage.pipeline_id, stage.status_id))
+        elif scenario == "get_contacts_bulk":
+            items = len(await client.get_contacts_bulk(fake.contact_ids(stage)))
+        elif scenario == "build_funnels_snapshot":
+            store = CRMStore(tmp / "crm.sqlite3")
+            pipeline_ids = list(dict.fromkeys(s.pipeline_id for s in fake.stages))
+            snap = await build_funnels_snapshot(client, store, tmp / "funnels.json", pipeline_ids)
+            items, leads = len(snap["funnels"]), 0
+        elif scenario == "cb_audience":
+            async def factory() -> AmoCRMClient:
+                return client
+
+            store = CRMStore(tmp / "crm.sqlite3")
+            contacts = await StageSync(factory, store).sync_stage(stage.pipeline_id, stage.status_id)
+            (tmp / "audience.json").write_text(json.dumps(contacts, ensure_ascii=False), "utf-8")
+            items = len(contacts)
+        else:
+            raise ValueError(f"Неизвестный сценарий: {scenario}")
+        seconds = time.perf_counter() - started
+    return {"leads": leads, "items": items, "seconds": seconds, "rss_mb": _peak_rss_mb()}
+
+
+async def _wait_server(url: str, timeout: float = 15) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"fake_amocrm не поднялся: {url}")
+            await asyncio.sleep(0.1)
+
+
+async def _server_stats(root: str, reset: bool = False) -> dict:
+    async with aiohttp.ClientSession() as session:
+        if reset:
+            async with session.post(f"{root}/_stats/reset"):
+                return {}
+        async with session.get(f"{root}/_stats") as r:
+            return await r.json()
+
+
+def bench(args: argparse.Namespace) -> list[dict]:
+    results = []
+    root = f"http://127.0.0.1:{args.port}"
+    for size in args.sizes:
+        server = subprocess.Popen(
+            [
+                sys.executable, str(BASE_DIR / "fake_amocrm.py"),
+                "--port", str(args.port),
+                "--stages", str(size),
+                "--latency", str(args.latency),
+                "--p429", str(args.p429),
+                "--retry-after", "0.5",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            asyncio.run(_wait_server(f"{root}/_stats"))
+            for scenario in args.scenarios:
+                asyncio.run(_server_stats(root, reset=True))
+                out = subprocess.run(
+                    [
+                        sys.executable, __file__, "_run", scenario,
+                        "--size", str(size),
+                        "--url", f"{root}/api/v4",
+                        "--rate-limit", str(args.rate_limit),
+                    ],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                row = json.loads(out.strip().splitlines()[-1])
+                stats = asyncio.run(_server_stats(root))
+                row.update(
+                    size=size,
+                    scenario=scenario,
+                    requests=stats.get("requests", 0),
+                    throttled=stats.get("429", 0),
+                )
+                results.append(row)
+                _print_row(row)
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def _legacy_normalize_phone(phone: str):
+    """normalize_phone до мемоизации и быстрого пути — эталон для сравнения."""
+    digits = re.sub(r"\D", "", phone)
+    if digits.startswith("8") and len(digits) == 11:
+        digits = "7" + digits[1:]
+    elif digits.startswith("7") and len(digits) == 11:
+        pass
+    elif digits.startswith("9") and len(digits) == 10:
+        digits = "7" + digits
+    digits = "+" + digits
+    try:
+        parsed = phonenumbers.parse(digits, None)
+        if phonenumbers.is_valid_number(parsed):
+            return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        pass
+    return False
+
+
+def phone_inputs(count: int, unique: int, seed: int = 1) -> list[str]:
+    """
+    Телефоны «как в amoCRM»: разные записи мобильных РФ, городские,
+    иностранные и мусор; `unique` разных номеров на `count` строк.
+    """
+    rnd = random.Random(seed)
+    formats = (
+        lambda d: f"+7{d}",
+        lambda d: f"8{d}",
+        lambda d: f"8 ({d[:3]}) {d[3:6]}-{d[6:8]}-{d[8:]}",
+        lambda d: f"+7 {d[:3]} {d[3:6]} {d[6:8]} {d[8:]}",
+        lambda d: d,
+    )
+    pool = []
+    for i in range(unique):
+        kind = i % 20
+        if kind < 16:
+            d = f"9{rnd.randrange(10**9):09d}"
+            pool.append(formats[kind % len(formats)](d))
+        elif kind == 16:
+            pool.append(f"+7 (495) {rnd.randrange(10**7):07d}")
+        elif kind == 17:
+            pool.append(f"+380 67 {rnd.randrange(10**7):07d}")
+        elif kind == 18:
+            pool.append(f"{rnd.randrange(10**6)}")
+        else:
+            pool.append("")
+    return [rnd.choice(pool) for _ in range(count)]
+
+
+def bench_phones(count: int, unique: int) -> None:
+    from amocrm_client import AmoCRMClient, _normalize_phone
+
+    phones = phone_inputs(count, unique)
+    started = time.perf_counter()
+    expected = [_legacy_normalize_phone(p) for p in phones]
+    legacy = time.perf_counter() - started
+
+    _normalize_phone.cache_clear()
+    started = time.perf_counter()
+    cold = AmoCRMClient.normalize_many(phones)
+    cold_s = time.perf_counter() - started
+    started = time.perf_counter()
+    warm = AmoCRMClient.normalize_many(phones)
+    warm_s = time.perf_counter() - started
+    assert cold == expected and warm == expected, "результаты нормализации разошлись"
+
+    print(f"{count:,} телефонов, {unique:,} разных")
+    for title, seconds in (
+        ("normalize_phone (прежний)", legacy),
+        ("normalize_many, холодный кэш", cold_s),
+        ("normalize_many, тёплый кэш", warm_s),
+    ):
+        print(f"{title:<30} {seconds:>8.3f} с {count / seconds:>12,.0f} /с {legacy / seconds:>7.1f}×")
+
+
+def _admin_gate(is_admin):
+    """Та же проверка, что admin_required в bot.py, с подменяемым `is_admin`."""
+    def decorator(func):
+        async def wrapper(message, *args, **kwargs):
+            if not is_admin(message.from_user.id):
+                return None
+            return await func(message)
+        return wrapper
+    return decorator
+
+
+async def _feed_updates(is_admin, count: int, admins: list[int]) -> float:
+    from aiogram import Bot, Dispatcher, Router
+    from aiogram.types import Chat, Message, Update, User
+
+    router = Router()
+    handled = 0
+
+    @router.message()
+    @_admin_gate(is_admin)
+    async def handler(message: Message):
+        nonlocal handled
+        handled += 1
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot("42:BENCH")
+    now = int(time.time())
+    updates = [
+        Update(
+            update_id=i,
+            message=Message(
+                message_id=i,
+                date=now,
+                chat=Chat(id=admins[i % len(admins)], type="private"),
+                from_user=User(id=admins[i % len(admins)], is_bot=False, first_name="bench"),
+                text="/start",
+            ),
+        )
+        for i in range(count)
+    ]
+    try:
+        started = time.perf_counter()
+        for update in updates:
+            await dp.feed_update(bot, update)
+        seconds = time.perf_counter() - started
+    finally:
+        await bot.session.close()
+    assert handled == count, "проверка админа отклонила апдейт"
+    return seconds
+
+
+def bench_router(count: int, admins_count: int) -> None:
+    from record_store import SQLiteStore
+
+    admins = list(range(10_000, 10_000 + admins_count))
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = Path(tmp) / "admins.json"
+        legacy.write_text(json.dumps(admins, indent=2), encoding="utf-8")
+        store = SQLiteStore(Path(tmp) / "bot.sqlite3", "admins", legacy_json=legacy)
+
+        def json_read(user_id: int) -> bool:  # JSONStore.read до перехода на SQLite
+            return user_id in json.loads(legacy.read_text(encoding="utf-8").strip())
+
+        cases = (
+            ("admins.json на каждый апдейт", json_read),
+            ("SQLiteStore.read()", lambda user_id: user_id in store.read()),
+            ("user_id in admins_store", lambda user_id: user_id in store),
+            ("без проверки", lambda user_id: True),
+        )
+        print(f"{count:,} апдейтов, админов: {admins_count}")
+        print(f"{'':<30} {'сек':>8} {'апд/с':>10} {'мкс/проверку':>14}")
+        for title, check in cases:
+            started = time.perf_counter()
+            for i in range(count):
+                check(admins[i % admins_count])
+            per_check = (time.perf_counter() - started) / count * 1e6
+            # лучший из двух прогонов — меньше шума от планировщика
+            seconds = min(asyncio.run(_feed_updates(check, count, admins)) for _ in range(2))
+            print(f"{title:<30} {seconds:>8.3f} {count / seconds:>10,.0f} {per_check:>14.2f}")
+
+
+def _print_row(row: dict) -> None:
+    rate = f"{row['leads'] / row['seconds']:>10,.0f}" if row["leads"] else f"{'—':>10}"
+    print(
+        f"{row['size']:>7,} {row['scenario']:<23} {row['seconds']:>8.2f} {rate} "
+        f"{row['requests']:>8} {row['throttled']:>5} {row['rss_mb']:>8.1f}",
+        flush=True,
+    )
+
+
+def _cli() -> None:
+    ap = argparse.ArgumentParser(description="Бенчмарк загрузки amoCRM на fake_amocrm.py")
+    sub = ap.add_subparsers(dest="cmd")
+    one = sub.add_parser("_run", help=argparse.SUPPRESS)
+    one.add_argument("scenario", choices=SCENARIOS)
+    one.add_argument("--size", type=int, required=True)
+    one.add_argument("--url", required=True)
+    one.add_argument("--rate-limit", type=float, default=7)
+    ph = sub.add_parser("phones", help="нормализация телефонов: прежняя против normalize_many")
+    ph.add_argument("--count", type=int, default=100_000)
+    ph.add_argument("--unique", type=int, default=30_000)
+    rt = sub.add_parser("router", help="проверка админа на апдейт: admins.json против кэша")
+    rt.add_argument("--updates", type=int, default=20_000)
+    rt.add_argument("--admins", type=int, default=5)
+
+    ap.add_argument("--sizes", default="1000,10000,100000")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--port", type=int, default=8770)
+    ap.add_argument("--latency", type=float, default=0.05, help="задержка ответа сервера, с")
+    ap.add_argument("--p429", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument(
+        "--rate-limit", type=float, default=7,
+        help="лимит клиента, запросов/с (у amoCRM — 7; больше — чтобы мерить сам клиент)",
+    )
+    args = ap.parse_args()
+
+    if args.cmd == "_run":
+        row = asyncio.run(run_scenario(args.scenario, args.size, args.url, args.rate_limit))
+        print(json.dumps(row))
+        return
+    if args.cmd == "phones":
+        bench_phones(args.count, args.unique)
+        return
+    if args.cmd == "router":
+        bench_router(args.updates, args.admins)
+        return
+
+    args.sizes = [int(x) for x in args.sizes.split(",") if x]
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    print(
+        f"{'сделок':>7} {'сценарий':<23} {'сек':>8} {'сделок/с':>10} "
+        f"{'запросов':>8} {'429':>5} {'RSS, МБ':>8}"
+    )
+    bench(args)
+
+
+if __name__ == "__main__":
+    _cli()
@@ -48,8 +48,6 @@ import os
 from aiogram.fsm.state import State, StatesGroup
 
 import aiohttp
-import phonenumbers
-import requests
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -84,6 +82,11 @@ def get_random_wait_time():
 
 AMOCRM_DIR = BASE_DIR / "amocrm_contacts"
 TEMP_CONTACTS_DIR = BASE_DIR / "temp_contacts"  # ← НОВАЯ СТРОКА
+DATA_DIR = BASE_DIR / "data"  # volume в docker-compose
+CRM_DB_FILE = DATA_DIR / "crm.sqlite3"
+BOT_DB_FILE = DATA_DIR / "bot.sqlite3"
+AUDIENCE_DIR = DATA_DIR / "audiences"  # снимки аудиторий по хешу содержимого
+CONF_FILE = BASE_DIR / "conf.json"
 AMOCRM_DIR.mkdir(exist_ok=True)
 
 # ---------------------------------------------------------------------------
@@ -151,15 +154,14 @@ def send_message_sync(dest: str, message: str, funnel: str = "") -> tuple[int, s
         return 0, error_msg
 
 # ---------------------------------------------------------------------------
-async def send_message_async(dest: str, message: str, funnel: str = "-") -> tuple[int, str]:
-    """Асинхронная отправка сообщения через WhatsApp (используем синхронный PyWhatKit)"""
+def _send_whatsapp_text(dest: str, message: str, funnel: str = "-") -> tuple[int, str]:
+    """Блокирующая отправка через PyWhatKit — выполняется только в потоке whatsapp_sender"""
     try:
         # Форматируем номер телефона
         if not dest.startswith('+'):
             dest = '+' + dest
             
-        # Отправляем сообщение через WhatsApp
-        import pywhatkit
+        # Отправляем сообщение через WhatsApp: браузер занят wait_time секунд
         pywhatkit.sendwhatmsg_instantly(
             phone_no=dest,
             message=message,
@@ -187,10 +189,13 @@ async def send_message_async(dest: str, message: str, funnel: str = "-") -> tupl
         
         return 500, error_msg
 
-                
-    except Exception as e:
-        logger.exception(f"Ошибка отправки сообщения: {e}")
-        return 500, str(e)
+
+async def send_message_async(dest: str, message: str, funnel: str = "-") -> tuple[int, str]:
+    """
+    Асинхронная отправка сообщения через WhatsApp: ставит отправку в очередь
+    whatsapp_sender и ждёт результат, не блокируя цикл событий бота
+    """
+    return await whatsapp_sender.submit(_send_whatsapp_text, dest, message, funnel)
 
 
 # ---------------------------------------------------------------------------
@@ -294,6 +299,7 @@ class Form(StatesGroup):
     STATE_TEMPLATE_NEW_2   = State()
     STATE_TEMPLATE_VIEW    = State()
     STATE_AUDIENCE         = State()
+    STATE_AUDIENCE_FILTER  = State()
     STATE_TIME_CHOOSE      = State()
     STATE_TIME_INPUT       = State()
     STATE_TIME_RANGE       = State()   # ← добавлено
@@ -308,146 +314,52 @@ class Form(StatesGroup):
 
 
 # ---------------------------------------------------------------------------
-# AmoCRM manager
-class AmoCRMCategoryManager:
-    def __init__(self) -> None:
-        cfg_path = os.path.join(os.path.dirname(__file__), "conf.json")
-        with open(cfg_path, encoding="utf-8") as fh:
-            cfg = json.load(fh)
-        acc = cfg["amocrm"]
-        self.subdomain: str = acc["subdomain"]
-        self.access_token: str = acc["access_token"]
-        self._base_urls = [
-            f"https://{self.subdomain}.amocrm.ru/api/v4",
-            f"https://{self.subdomain}.kommo.com/api/v4",
-        ]
-        self.headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-        self.base_url: str = self._detect_base_url()
+# AmoCRM: один долгоживущий асинхронный клиент на весь бот
+from amocrm_client import SYSTEM_STAGES, AmoCRMClient
+from audience_sets import AudienceFormula, compose
+from contact_snapshot import AudienceStore, count_contacts, open_contacts
+from crm_filters import AudienceFilter, parse_day_range
+from crm_store import ContactCache, CRMStore
+from crm_sync import StagePrefetcher, StageSync
+from crm_webhook import WebhookReceiver
+from error_numbers import ErrorNumberRegistry
+from record_store import SQLiteStore
+from sender_worker import SenderWorker
+from suppression import SuppressionIndex
+
+mgr: AmoCRMClient | None = None
+# Локальное зеркало amoCRM: этапы, сделки, контакты, телефоны
+crm_store = CRMStore(CRM_DB_FILE)
+# Общий для всех этапов кэш контактов (TTL + LRU, хранится в том же SQLite)
+contact_cache = ContactCache(crm_store)
+# Выбранные аудитории: один неизменяемый снимок на уникальное содержимое
+audience_store = AudienceStore(AUDIENCE_DIR)
+# Поток-владелец браузера: отправки PyWhatKit идут по одной и не блокируют бота
+whatsapp_sender = SenderWorker(name="whatsapp-sender")
+
+
+def cleanup_audiences() -> None:
+    """Удаляет снимки аудиторий, на которые не ссылается ни одна задача."""
+    try:
+        audience_store.gc(j.get("audience") for j in scheduled_store.read())
+    except Exception:
+        logger.exception("Не удалось почистить снимки аудиторий")
 
-    def _detect_base_url(self) -> str:
-        for url in self._base_urls:
-            try:
-                if (
-                    requests.get(
-                        f"{url}/account", headers=self.headers, timeout=6
-                    ).status_code
-                    == 200
-                ):
-                    return url
-            except requests.exceptions.RequestException:
-                pass
-        raise RuntimeError("Не удалось найти рабочий домен Kommo")
 
-    def get_pipelines(self) -> list[tuple[int, str]]:
-        r = requests.get(
-            f"{self.base_url}/leads/pipelines", headers=self.headers, timeout=20
-        )
-        r.raise_for_status()
-        return [(p["id"], p["name"]) for p in r.json()["_embedded"]["pipelines"]]
-
-    def get_pipeline_statuses(self, pipeline_id: int) -> list[tuple[int, str]]:
-        """Получить статусы пайплайна с фильтрацией системных этапов"""
-        r = requests.get(
-            f"{self.base_url}/leads/pipelines/{pipeline_id}/statuses",
-            headers=self.headers,
-            timeout=20
-        )
-        r.raise_for_status()
-        
-        # Системные этапы для исключения
-        system_stages = ['Неразобранное', 'Успешно реализовано', 'Закрыто и не реализовано']
-        
-        statuses = []
-        for status in r.json()["_embedded"]["statuses"]:
-            status_name = status["name"]
-            if status_name not in system_stages:
-                statuses.append((status["id"], status_name))
-        
-        return statuses
+def job_contacts_path(job: dict) -> Path:
+    """Файл аудитории задачи: снимок по хешу или (старые задачи) путь к файлу."""
+    if job.get("audience"):
+        return audience_store.path(job["audience"])
+    return Path(job["contacts"])
 
-    def get_leads(self, pipeline_id: int, status_id: int) -> list[dict]:
-        out, page = [], 1
-        while True:
-            params = {
-                "limit": 250,
-                "page": page,
-                "filter[statuses][0][pipeline_id]": pipeline_id,
-                "filter[statuses][0][status_id]": status_id,
-                "with": "contacts",
-            }
-            r = requests.get(
-                f"{self.base_url}/leads",
-                headers=self.headers,
-                params=params,
-                timeout=20,
-            )
-            if r.status_code == 204:
-                break
-            r.raise_for_status()
-            batch = r.json()["_embedded"]["leads"]
-            if not batch:
-                break
-            out.extend(batch)
-            page += 1
-        return out
-
-    def get_leads_all_statuses(self, pipeline_id: int) -> list[dict]:
-        """Возвращает все сделки во всех статусах указанного этапа."""
-        all_leads = []
-        for status_id, _ in self.get_pipeline_statuses(pipeline_id):
-            all_leads.extend(self.get_leads(pipeline_id, status_id))
-        return all_leads
-
-    def get_contacts_bulk(self, ids: list[int]) -> dict[int, dict]:
-        result: dict[int, dict] = {}
-        ids_iter = iter(ids)
-        while chunk := list(islice(ids_iter, 200)):
-            params = {"with": "custom_fields_values"}
-            params.update({f"id[{i}]": cid for i, cid in enumerate(chunk)})
-            r = requests.get(
-                f"{self.base_url}/contacts",
-                headers=self.headers,
-                params=params,
-                timeout=20,
-            )
-            if r.status_code != 200:
-                continue
-            for c in r.json()["_embedded"]["contacts"]:
-                result[c["id"]] = c
-        return result
-
-    @staticmethod
-    def extract_phone(cfv: list[dict]) -> str:
-        for fld in cfv or []:
-            if fld.get("field_code") == "PHONE":
-                for val in fld.get("values", []):
-                    phone = str(val.get("value", "")).strip()
-                    if phone:
-                        return phone
-        return ""
-
-    @staticmethod
-    def normalize_phone(phone: str):
-        digits = re.sub(r"\D", "", phone)
-        if digits.startswith("8") and len(digits) == 11:
-            digits = "7" + digits[1:]
-        elif digits.startswith("7") and len(digits) == 11:
-            pass
-        elif digits.startswith("9") and len(digits) == 10:
-            digits = "7" + digits
-        digits = "+" + digits
-        try:
-            parsed = phonenumbers.parse(digits, None)
-            if phonenumbers.is_valid_number(parsed):
-                return phonenumbers.format_number(
-                    parsed, phonenumbers.PhoneNumberFormat.E164
-                )
-        except phonenumbers.phonenumberutil.NumberParseException:
-            pass
-        return False
+
+async def get_amocrm() -> AmoCRMClient:
+    """Возвращает общий клиент amoCRM, при необходимости создаёт его заново."""
+    global mgr
+    if mgr is None:
+        mgr = AmoCRMClient(contact_cache=contact_cache, store=crm_store)
+    await mgr.start()
+    return mgr
 
 # ---------------------------------------------------------------------------
 from main import build_funnels_snapshot
@@ -455,23 +367,17 @@ from main import build_funnels_snapshot
 
 
 # ---------------------------------------------------------------------------
-# Обновляем список этапов: чистим папку и пишем funnels.json
+# Обновляем список этапов: перезаписываем funnels.json.
+# Снимки этапов не удаляем — они досинхронизируются дельтой (crm_sync.StageSync)
 async def update_amocrm_funnels() -> str:
     attempt = 0
     max_attempts = 3
     pause_seconds = 10
     
-    # Чистим папку один раз в начале
-    for f in AMOCRM_DIR.glob("*.json"):
-        try:
-            f.unlink()
-        except Exception:
-            logger.warning("Не смог удалить %s", f)
-    
     # Цикл с повторными попытками
     while attempt < max_attempts:
         try:
-            snap = await asyncio.to_thread(build_funnels_snapshot)
+            snap = await build_funnels_snapshot(await get_amocrm(), crm_store)
             return f"✅ Найденно {len(snap['funnels'])} этапов, данные успешно синхронизированы с amo crm."
         except Exception as e:
             attempt += 1
@@ -488,53 +394,11 @@ async def update_amocrm_funnels() -> str:
     return "❌ Неожиданная ошибка при обновлении этапов"
 
 
-class JSONStore:
-    def __init__(self, path: Path):
-        self.path = path
-
-    def read(self) -> list:
-        """Read data from JSON file with proper error handling"""
-        try:
-            if not self.path.exists():
-                return []
-            
-            content = self.path.read_text(encoding="utf-8").strip()
-            if not content:
-                return []
-                
-            return json.loads(content)
-        except (json.JSONDecodeError, FileNotFoundError) as e:
-            logger.warning(f"Error reading {self.path}: {e}. Returning empty list.")
-            return []
-        except Exception as e:
-            logger.error(f"Unexpected error reading {self.path}: {e}")
-            return []
-
-    def write(self, data: list):
-        """Write data to JSON file"""
-        try:
-            self.path.write_text(
-                json.dumps(data, ensure_ascii=False, indent=2), 
-                encoding="utf-8"
-            )
-        except Exception as e:
-            logger.error(f"Error writing to {self.path}: {e}")
-
-    def append(self, item):
-        """Append item to the list"""
-        data = self.read()
-        data.append(item)
-        self.write(data)
-
-    def remove(self, predicate_func):
-        """Remove items matching predicate"""
-        data = self.read()
-        filtered = [item for item in data if not predicate_func(item)]
-        self.write(filtered)
-
-
-admins_store = JSONStore(BASE_DIR / "admins.json")
-scheduled_store = JSONStore(BASE_DIR / "scheduled.json")
+# Админы и запланированные задачи — в SQLite (WAL); старые JSON переносятся один раз
+admins_store = SQLiteStore(BOT_DB_FILE, "admins", legacy_json=BASE_DIR / "admins.json")
+scheduled_store = SQLiteStore(
+    BOT_DB_FILE, "scheduled", key=lambda job: job["job_id"], legacy_json=BASE_DIR / "scheduled.json"
+)
 
 def admin_required(func):
     async def wrapper(message_or_query, state: FSMContext, *args, **kwargs):
@@ -543,7 +407,7 @@ def admin_required(func):
             if isinstance(message_or_query, (Message, CallbackQuery))
             else None
         )
-        if user_id not in admins_store.read():
+        if user_id not in admins_store:  # множество в памяти, без чтения файла/БД
             if isinstance(message_or_query, CallbackQuery):
                 await message_or_query.message.reply_text(f"❌ Доступ запрещён. Ваш ID: <code>{user_id}</code>")
             else:
@@ -589,17 +453,8 @@ def ensure_dirs():
             encoding="utf-8"
         )
     
-    # Initialize scheduled jobs file (КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ)
-    scheduled_file = BASE_DIR / "scheduled.json"
-    if not scheduled_file.exists() or scheduled_file.stat().st_size == 0:
-        scheduled_file.write_text("[]", encoding="utf-8")
-        logger.info("Initialized empty scheduled jobs file")
-    
-    # Initialize admins file
-    admins_file = BASE_DIR / "admins.json"
-    if not admins_file.exists() or admins_file.stat().st_size == 0:
-        admins_file.write_text("[]", encoding="utf-8")
-        logger.info("Initialized empty admins file")
+    # scheduled.json / admins.json больше не создаются: задачи и админы — в BOT_DB_FILE,
+    # старые файлы читаются один раз при переносе (record_store.SQLiteStore)
 
 
 def local_offset() -> timedelta:
@@ -740,12 +595,11 @@ import random
 async def job_send_distribution(context):
     try:
         job = context.data
-        contacts_path = Path(job["contacts"])
+        contacts_path = job_contacts_path(job)
         if not contacts_path.exists():
             logger.error("Контактный файл %s не найден", contacts_path)
             return
 
-        contacts_data = json.loads(contacts_path.read_text("utf-8"))
         templates = json.loads(TEMPLATES_FILE.read_text("utf-8"))
         template = next((t for t in templates if t["id"] == job["template_id"]), None)
         if not template:
@@ -756,46 +610,60 @@ async def job_send_distribution(context):
         day_until = datetime.strptime(job.get("day_until", "23:59"), "%H:%M").time()
         photo_file_id = job.get("photo_file_id")
 
-        for contact in contacts_data:
-            while True:
-                now_local = (now_tz() + local_offset()).time()
-                if day_from <= now_local <= day_until:
-                    break
-                await asyncio.sleep(60)
-
-            message = template["content"].format(
-                name=contact["name"],
-                message=json.loads(MAIN_DATA.read_text(encoding="utf-8"))["2"]
-            )
-            if photo_file_id:
-                code, resp = await send_message_with_photo_async(
-                    dest=contact["phone"],
-                    message=message,
-                    photo_file_id=photo_file_id,
-                    funnel=job["job_id"]
-                )
-            else:
-                code, resp = await send_message_async(
-                    dest=contact["phone"],
-                    message=message,
-                    funnel=job["job_id"]
+        # Снимок читается по одному контакту; offset — сколько уже отправлено,
+        # он сохраняется в задаче (scheduled_store), и после перезапуска рассылка продолжается с него
+        offset = int(job.get("offset", 0))
+        # Отметка начала: рассылку, ждущую окна day_from или первой отправки,
+        # restore_scheduled_jobs продолжит после перезапуска, а не удалит как просроченную
+        scheduled_store.update_key(
+            job["job_id"], started_at=job.get("started_at") or now_tz().isoformat(), offset=offset
+        )
+        with open_contacts(contacts_path) as contacts_data:
+            total = len(contacts_data)
+            if offset:
+                logger.info("Рассылка %s продолжается с %d из %d", job["job_id"], offset, total)
+            for index, contact in enumerate(contacts_data.iter_from(offset), offset):
+                while True:
+                    now_local = (now_tz() + local_offset()).time()
+                    if day_from <= now_local <= day_until:
+                        break
+                    await asyncio.sleep(60)
+
+                message = template["content"].format(
+                    name=contact["name"],
+                    message=json.loads(MAIN_DATA.read_text(encoding="utf-8"))["2"]
                 )
+                if photo_file_id:
+                    code, resp = await send_message_with_photo_async(
+                        dest=contact["phone"],
+                        message=message,
+                        photo_file_id=photo_file_id,
+                        funnel=job["job_id"]
+                    )
+                else:
+                    code, resp = await send_message_async(
+                        dest=contact["phone"],
+                        message=message,
+                        funnel=job["job_id"]
+                    )
 
-            log_extra = {
-                "template": job["template_id"],
-                "funnel": job["job_id"],
-                "phone": contact["phone"],
-                "success": code == 202,
-                "err": "" if code == 202 else resp
-            }
-            level = logging.INFO if code == 202 else logging.ERROR
-            logger.log(level, "%s → %s", contact["phone"], "OK" if code == 202 else f"ERR {code}", extra=log_extra)
-            pause_seconds = random.randint(10, 15) #исправить
-            logger.info(f"Пауза между отправками: {pause_seconds} секунд")
-            await asyncio.sleep(pause_seconds)
+                log_extra = {
+                    "template": job["template_id"],
+                    "funnel": job["job_id"],
+                    "phone": contact["phone"],
+                    "success": code == 202,
+                    "err": "" if code == 202 else resp
+                }
+                level = logging.INFO if code == 202 else logging.ERROR
+                logger.log(level, "%s → %s", contact["phone"], "OK" if code == 202 else f"ERR {code}", extra=log_extra)
+                scheduled_store.update_key(job["job_id"], offset=index + 1)
+                pause_seconds = random.randint(10, 15) #исправить
+                logger.info(f"Пауза между отправками: {pause_seconds} секунд")
+                await asyncio.sleep(pause_seconds)
 
-        scheduled_store.remove(lambda x: x["job_id"] == job["job_id"])
-        logger.info("Рассылка %s завершена (%d номеров)", job["job_id"], len(contacts_data))
+        scheduled_store.delete(job["job_id"])
+        cleanup_audiences()
+        logger.info("Рассылка %s завершена (%d номеров)", job["job_id"], total)
 
     except Exception:
         logger.exception("Ошибка в job_send_distribution")
@@ -904,7 +772,8 @@ def schedule_job(run_at: datetime,
                 day_from: str = "10:00",
                 day_until: str = "22:00",
                 photo_file_id: str = None,
-                funnel_name: str = "") -> str:  # ДОБАВЛЕНО: параметр funnel_name
+                funnel_name: str = "",  # ДОБАВЛЕНО: параметр funnel_name
+                audience: str | None = None) -> str:
     
     job_id = f"job_{uuid.uuid4().hex[:8]}"
     data = {
@@ -917,6 +786,8 @@ def schedule_job(run_at: datetime,
         "day_until": day_until,
         "funnel_name": funnel_name,  # ДОБАВЛЕНО: сохраняем название этапы
     }
+    if audience:
+        data["audience"] = audience  # хеш снимка в audience_store — ссылка для gc
     if photo_file_id:
         data["photo_file_id"] = photo_file_id
 
@@ -968,6 +839,11 @@ async def handle_menu(message: Message, state: FSMContext):
     text = message.text
     
     if text == "Выбрать этап":
+        # Этапы обновляет фоновый прогрев; синхронно — только при пустом зеркале
+        if crm_store.statuses():
+            age = time.time() - float(crm_store.get_meta("funnels_at", "0"))
+            await ask_audience(message, state, f"🕒 Список этапов обновлён {_format_age(age)}")
+            return
         await message.answer("🔄 Обновляем этапы…")
         result = await update_amocrm_funnels()
         await ask_audience(message, state, result)
@@ -1291,51 +1167,90 @@ async def ask_audience(
     message: Message | CallbackQuery,
     state: FSMContext,
     update_result: str | None = None,
+    pipeline_id: int | None = None,
 ):
-    snap_path = AMOCRM_DIR / "funnels.json"
-    if not snap_path.exists():
+    """
+    Выбор аудитории в два уровня: воронка → этап. Если отслеживается
+    одна воронка (или `pipeline_id` уже выбран), сразу показываются этапы.
+    """
+    answer = (
+        message.answer
+        if isinstance(message, Message)
+        else message.message.edit_text
+    )
+    pipelines = crm_store.pipelines()
+    flt = AudienceFilter.from_dict((await state.get_data()).get("audience_filter"))
+    header = (f"{update_result}\n\n" if update_result else "") + _filter_line(flt)
+
+    if pipeline_id is None and len(pipelines) > 1:
+        buttons = []
+        for item in pipelines:
+            count = sum(
+                1 for st in crm_store.statuses(item["pipeline_id"])
+                if st["name"] not in SYSTEM_STAGES
+            )
+            buttons.append([InlineKeyboardButton(
+                text=f"🗂 {item['name']} · {count} эт.",
+                callback_data=f"pipe:{item['pipeline_id']}",
+            )])
+        buttons.append([InlineKeyboardButton(text="🔎 Фильтры аудитории", callback_data="flt:menu")])
+        await answer(header + "🗂 Выберите воронку:", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        await state.update_data(funnel_map={}, audience_pipeline=None)
+        await state.set_state(Form.STATE_AUDIENCE)
+        return
+
+    if pipeline_id is None and pipelines:
+        pipeline_id = pipelines[0]["pipeline_id"]
+    stages = crm_store.statuses(pipeline_id)
+    if not stages:
         await (
             message.answer
             if isinstance(message, Message)
             else message.message.answer
-        )("❌ Нет файла funnels.json – нажмите ещё раз «Просмотр шаблонов».")
+        )("❌ Список этапов пуст – нажмите ещё раз «Выбрать этап».")
         return
 
-    snap = json.loads(snap_path.read_text("utf-8"))
     buttons = [
-        [InlineKeyboardButton(text="👥 Все этапы", callback_data="aud:all")]
+        [InlineKeyboardButton(text="👥 Все этапы", callback_data="aud:all")],
+        [InlineKeyboardButton(text="🧮 Составить из этапов", callback_data="mix:menu")],
+        [InlineKeyboardButton(text="🔎 Фильтры аудитории", callback_data="flt:menu")],
     ]
 
-    # Системные этапы для исключения
-    system_stages = ['Неразобранное', 'Успешно реализовано', 'Закрыто и не реализовано']
-
     funnel_map = {}
-    for idx, item in enumerate(snap["funnels"]):
+    for idx, item in enumerate(stages):
         # Фильтруем системные этапы
-        if item['name'] not in system_stages:
+        if item['name'] not in SYSTEM_STAGES:
             fid = f"f{idx}"
-            funnel_map[fid] = item["file"]
+            funnel_map[fid] = item["status_id"]
+            age = stage_sync.data_age(item["status_id"])
+            suffix = f" · {item['leads']} сд., {_format_age(age)}" if age is not None else ""
             buttons.append(
                 [
                     InlineKeyboardButton(
-                        text=f"📂 {item['name']}", callback_data=f"aud:{fid}"
+                        text=f"📂 {item['name']}{suffix}", callback_data=f"aud:{fid}"
                     )
                 ]
             )
+    if len(pipelines) > 1:
+        buttons.append([InlineKeyboardButton(text="⬅️ К воронкам", callback_data="pipe:list")])
+        name = next((p["name"] for p in pipelines if p["pipeline_id"] == pipeline_id), pipeline_id)
+        header += f"🗂 Воронка: {name}\n"
 
+    await answer(
+        header + "🎯 Выберите аудиторию:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+    )
 
-    text = (
-        f"{update_result}\n\n" if update_result else ""
-    ) + "🎯 Выберите аудиторию:"
+    await state.update_data(funnel_map=funnel_map, audience_pipeline=pipeline_id)
+    await state.set_state(Form.STATE_AUDIENCE)
 
-    await (
-        message.answer
-        if isinstance(message, Message)
-        else message.message.edit_text
-    )(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
 
-    await state.update_data(funnel_map=funnel_map)
-    await state.set_state(Form.STATE_AUDIENCE)
+@router.callback_query(F.data.startswith("pipe:"))
+@admin_required
+async def cb_pipeline(query: CallbackQuery, state: FSMContext):
+    await query.answer()
+    value = query.data.split(":", 1)[1]
+    await ask_audience(query, state, pipeline_id=None if value == "list" else int(value))
 
 # ---------------------------------------------------------------------------
 async def fetch_templates(prefix: str = "view_tpl"):
@@ -1445,35 +1360,354 @@ async def cb_view_tpl(query: CallbackQuery, state: FSMContext):
 
 # ---------------------------------------------------------------------------
 
-def write_error_with_phone_check(lead_id, lead_name, phone, contact_name):
-    """Простая проверка: если номер уже есть в файле - не записываем"""
-    error_file = 'logs/Error_numbers.csv'
-    
-    # Читаем существующие номера телефонов
-    existing_phones = set()
+# Ошибочные номера: индекс в памяти, запись пачкой в конце выгрузки этапа
+error_registry = ErrorNumberRegistry(Path("logs") / "Error_numbers.csv")
+
+
+def _on_bad_phone(lead: dict, phone_raw: str, name: str) -> None:
+    error_registry.add(
+        lead["id"], lead.get("name", ""), phone_raw, name,
+        pipeline_id=lead.get("pipeline_id"), status_id=lead.get("status_id"),
+    )
+
+
+# Инкрементальная синхронизация этапов: повторный выбор этапа качает только дельту
+stage_sync = StageSync(
+    get_amocrm, crm_store, on_bad_phone=_on_bad_phone, on_download_done=error_registry.flush
+)
+
+
+def _format_age(seconds: float | None) -> str:
+    """«только что», «5 мин назад», «3 ч назад» — возраст данных для подписей."""
+    if seconds is None:
+        return "ещё не загружались"
+    if seconds < 60:
+        return "только что"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин назад"
+    if seconds < 48 * 3600:
+        return f"{int(seconds // 3600)} ч назад"
+    return f"{int(seconds // 86400)} дн назад"
+
+
+def _stages_by_pipeline() -> dict[int, list[int]]:
+    """Несистемные этапы зеркала по воронкам — то, что админ видит в «Выбрать этап»."""
+    out: dict[int, list[int]] = {}
+    for item in crm_store.statuses():
+        if item["name"] not in SYSTEM_STAGES:
+            out.setdefault(item["pipeline_id"], []).append(item["status_id"])
+    return out
+
+
+async def _refresh_funnels_background() -> None:
+    await build_funnels_snapshot(await get_amocrm(), crm_store)
+
+
+def start_stage_prefetcher() -> asyncio.Task | None:
+    """
+    Фоновый прогрев этапов. Настройки — секция "prefetch" в conf.json:
+    {"enabled": true, "interval": 300, "idle_seconds": 30}.
+    """
+    try:
+        cfg = json.loads(CONF_FILE.read_text(encoding="utf-8")).get("prefetch") or {}
+    except Exception as e:
+        logger.warning("Не удалось прочитать conf.json для прогрева: %s", e)
+        cfg = {}
+    if not cfg.get("enabled", True):
+        return None
+    prefetcher = StagePrefetcher(
+        stage_sync,
+        _refresh_funnels_background,
+        _stages_by_pipeline,
+        interval=float(cfg.get("interval", 300)),
+        idle_seconds=float(cfg.get("idle_seconds", 30)),
+    )
+    return asyncio.create_task(prefetcher.run())
+
+
+# ---------------------------------------------------------------------------
+# Фильтры аудитории: ответственный и даты уходят в запрос amoCRM,
+# теги и доп. поля проверяются на сделках в потоке (crm_filters.AudienceFilter)
+FILTER_PROMPTS = {
+    "tags": "🏷 Теги через запятую — подойдёт сделка хотя бы с одним из них.",
+    "resp": "👤 ID ответственных через запятую.",
+    "created": "📅 Дата создания сделки: <code>ДД.ММ.ГГГГ–ДД.ММ.ГГГГ</code> (одну границу можно опустить).",
+    "updated": "🕒 Дата изменения сделки: <code>ДД.ММ.ГГГГ–ДД.ММ.ГГГГ</code> (одну границу можно опустить).",
+    "cf": "🧩 Доп. поле: <code>ID_поля=значение1|значение2</code>.",
+}
+
+
+def _filter_line(flt: AudienceFilter) -> str:
+    return f"🔎 Фильтр: {flt.describe()}\n" if not flt.is_empty() else ""
+
+
+def _conf_responsible_user_id() -> int | None:
     try:
-        if os.path.exists(error_file) and os.path.getsize(error_file) > 0:
-            with open(error_file, mode='r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                next(reader, None)  # пропускаем заголовок
-                for row in reader:
-                    if len(row) >= 3:  # проверяем что есть колонка phone (3-я колонка)
-                        existing_phones.add(row[2])
+        value = json.loads(CONF_FILE.read_text(encoding="utf-8"))["amocrm"].get("responsible_user_id")
+        return int(value) if value else None
     except Exception:
-        pass  # если не можем прочитать, продолжаем
-    
-    # Если номер уже есть - не записываем
-    if str(phone) in existing_phones:
-        return False  # номер уже существует, не записали
-    
-    # Записываем в файл только если номера еще нет
-    with open(error_file, mode='a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([lead_id, lead_name, phone, contact_name])
-    
-    return True  # номер записан
+        return None
+
+
+def _conf_suppression_hours() -> float:
+    """conf.json: "suppression": {"hours": 24} — 0 отключает подавление."""
+    try:
+        cfg = json.loads(CONF_FILE.read_text(encoding="utf-8")).get("suppression") or {}
+        return float(cfg.get("hours", 24))
+    except Exception:
+        return 24.0
+
+
+# Недавние доставки: номер, которому уже писали внутри окна, не попадает в аудиторию
+suppression = SuppressionIndex(
+    Path("logs") / "delivery_logs.csv",
+    DATA_DIR / "suppression.json",
+    window_hours=_conf_suppression_hours(),
+)
+
+
+def drop_recent(contacts: list[dict]) -> tuple[list[dict], str]:
+    """Убирает недавно получивших сообщение: (контакты, строка для подписи)."""
+    try:
+        kept, dropped = suppression.filter(contacts)
+    except Exception:
+        logger.exception("Не удалось применить подавление повторных отправок")
+        return contacts, ""
+    if not dropped:
+        return kept, ""
+    return kept, f"🚫 Уже получили сообщение за {suppression.window_hours:g} ч: {dropped}\n"
+
+
+async def load_audience(
+    pipeline_id: int, status_ids: list[int], flt: AudienceFilter
+) -> list[dict]:
+    """Аудитория этапов: из зеркала, а с фильтром — потоком прямо из amoCRM."""
+    if flt.is_empty():
+        return await stage_sync.sync_stages(pipeline_id, status_ids)
+    return await stage_sync.filtered_audience(pipeline_id, status_ids, flt)
+
+
+async def load_stage_audiences(
+    pipeline_id: int, status_ids: list[int], flt: AudienceFilter
+) -> dict[int, list[dict]]:
+    """Аудитории этапов по отдельности: status_id → [{"phone", "name"}, …]."""
+    if flt.is_empty():
+        await stage_sync.sync_stages(pipeline_id, status_ids)
+        return {sid: crm_store.audience(pipeline_id, [sid]) for sid in status_ids}
+    audiences = await asyncio.gather(*(
+        stage_sync.filtered_audience(pipeline_id, [sid], flt) for sid in status_ids
+    ))
+    return dict(zip(status_ids, audiences))
+
+
+# ---------------------------------------------------------------------------
+# Составная аудитория: этапы ∪ / ∩ / ∖ и минус номера с ошибкой доставки
+MIX_MARKS = {None: "▫️", "include": "➕", "intersect": "✖️", "exclude": "➖"}
+
+
+async def show_mix_menu(query: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    formula = AudienceFormula.from_dict(data.get("audience_mix"))
+    names = {}
+    buttons = []
+    for fid, sid in (data.get("funnel_map") or {}).items():
+        names[sid] = (crm_store.status(sid) or {}).get("name", str(sid))
+        buttons.append([InlineKeyboardButton(
+            text=f"{MIX_MARKS[formula.role(sid)]} {names[sid]}", callback_data=f"mix:t:{fid}"
+        )])
+    buttons += [
+        [InlineKeyboardButton(
+            text=("✅" if formula.minus_failed else "▫️") + " Минус номера с ошибкой доставки",
+            callback_data="mix:failed",
+        )],
+        [InlineKeyboardButton(text="🧮 Собрать аудиторию", callback_data="mix:go")],
+        [InlineKeyboardButton(text="♻️ Сбросить", callback_data="mix:reset")],
+        [InlineKeyboardButton(text="⬅️ К этапам", callback_data="mix:back")],
+    ]
+    await query.message.edit_text(
+        "🧮 Нажимайте на этапы: ➕ объединить, ✖️ пересечь, ➖ исключить.\n"
+        f"{_filter_line(AudienceFilter.from_dict(data.get('audience_filter')))}"
+        f"Формула: {formula.describe(names)}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+    )
+
+
+@router.callback_query(F.data.startswith("mix:"))
+@admin_required
+async def cb_audience_mix(query: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    formula = AudienceFormula.from_dict(data.get("audience_mix"))
+    action = query.data.split(":", 2)[1:]
+    if action == ["go"] and formula.is_empty():
+        await query.answer("Отметьте хотя бы один этап ➕ или ✖️", show_alert=True)
+        return
+    await query.answer()
+
+    if action == ["back"]:
+        await ask_audience(query, state, pipeline_id=data.get("audience_pipeline"))
+        return
+    if action == ["reset"]:
+        formula = AudienceFormula()
+    elif action == ["failed"]:
+        formula.minus_failed = not formula.minus_failed
+    elif action[0] == "t" and action[1:]:
+        sid = (data.get("funnel_map") or {}).get(action[1])
+        if sid is not None:
+            formula.cycle(sid)
+    elif action == ["go"]:
+        await build_mixed_audience(query, state, formula)
+        return
+    await state.update_data(audience_mix=formula.to_dict())
+    await show_mix_menu(query, state)
+
 
+async def build_mixed_audience(query: CallbackQuery, state: FSMContext, formula: AudienceFormula):
+    data = await state.get_data()
+    flt = AudienceFilter.from_dict(data.get("audience_filter"))
+    names = {sid: (crm_store.status(sid) or {}).get("name", str(sid)) for sid in formula.stage_ids()}
+    by_pipeline: dict[int, list[int]] = {}
+    for sid in formula.stage_ids():
+        pid = (crm_store.status(sid) or {}).get("pipeline_id", data.get("audience_pipeline"))
+        by_pipeline.setdefault(pid, []).append(sid)
+
+    await query.message.edit_text("⏳ Собираю аудиторию…")
+    try:
+        audiences: dict[int, list[dict]] = {}
+        for part in await asyncio.gather(*(
+            load_stage_audiences(pid, sids, flt) for pid, sids in by_pipeline.items()
+        )):
+            audiences.update(part)
+    except Exception as e:
+        await query.message.answer(f"❌ Ошибка при загрузке контактов: {e}")
+        return
+    # Error_numbers.csv тут не годится: там только номера, не прошедшие
+    # нормализацию, — в аудиторию они не попадают. Вычитаем номера из аудитории,
+    # последняя отправка на которые не удалась (logs/delivery_logs.csv)
+    excluded = suppression.failed_phones() if formula.minus_failed else set()
+    started = time.perf_counter()
+    contacts = compose(formula, audiences, excluded)
+    label = formula.describe(names)
+    logger.info(
+        "Составная аудитория %s: %d контактов за %.1f мс",
+        label, len(contacts), (time.perf_counter() - started) * 1000,
+    )
+    contacts, recent_line = drop_recent(contacts)
+    if not contacts:
+        await query.message.edit_text(
+            f"❌ По формуле «{label}» контактов нет.\n{recent_line}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬅️ Изменить", callback_data="mix:menu")],
+            ]),
+        )
+        return
 
+    digest = audience_store.put(contacts)
+    await state.update_data(
+        contacts=str(audience_store.path(digest)), audience=digest, audience_label=label,
+        audience_mix=formula.to_dict(),
+    )
+    cnt = len(contacts)
+    await query.message.edit_text(
+        f"🧮 Аудитория: {label}\n"
+        f"📊 Контактов: {cnt}\n"
+        f"{recent_line}"
+        f"{_filter_line(flt)}"
+        f"⏳ Оценка длительности рассылки: от {timedelta(seconds=40 * cnt)} до {timedelta(seconds=345 * cnt)}\n"
+        "⚠️ Продолжить?",
+        reply_markup=InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="✅ Да", callback_data="aud_f_yes")],
+                [InlineKeyboardButton(text="⬅️ Изменить", callback_data="mix:menu")],
+            ]
+        ),
+    )
+
+
+async def show_filter_menu(query: CallbackQuery, state: FSMContext):
+    flt = AudienceFilter.from_dict((await state.get_data()).get("audience_filter"))
+    buttons = [
+        [InlineKeyboardButton(text="🏷 Теги", callback_data="flt:set:tags")],
+        [InlineKeyboardButton(text="👤 Ответственный", callback_data="flt:set:resp")],
+    ]
+    my_id = _conf_responsible_user_id()
+    if my_id:
+        buttons.append([InlineKeyboardButton(
+            text=f"👤 Только {my_id} (из conf.json)", callback_data="flt:me"
+        )])
+    buttons += [
+        [InlineKeyboardButton(text="📅 Дата создания", callback_data="flt:set:created")],
+        [InlineKeyboardButton(text="🕒 Дата изменения", callback_data="flt:set:updated")],
+        [InlineKeyboardButton(text="🧩 Доп. поле", callback_data="flt:set:cf")],
+        [InlineKeyboardButton(text="♻️ Сбросить", callback_data="flt:reset")],
+        [InlineKeyboardButton(text="⬅️ К этапам", callback_data="flt:back")],
+    ]
+    await query.message.edit_text(
+        f"🔎 Фильтр аудитории: {flt.describe()}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+    )
+
+
+@router.callback_query(F.data.startswith("flt:"))
+@admin_required
+async def cb_audience_filter(query: CallbackQuery, state: FSMContext):
+    await query.answer()
+    data = await state.get_data()
+    flt = AudienceFilter.from_dict(data.get("audience_filter"))
+    action = query.data.split(":", 2)[1:]
+
+    if action == ["back"]:
+        await ask_audience(query, state, pipeline_id=data.get("audience_pipeline"))
+        return
+    if action == ["reset"]:
+        await state.update_data(audience_filter=None)
+    elif action == ["me"]:
+        my_id = _conf_responsible_user_id()
+        if my_id:
+            flt.responsible_user_ids = [my_id]
+            await state.update_data(audience_filter=flt.to_dict())
+    elif action[0] == "set" and action[1:] and action[1] in FILTER_PROMPTS:
+        await state.update_data(filter_field=action[1])
+        await state.set_state(Form.STATE_AUDIENCE_FILTER)
+        await query.message.edit_text(
+            FILTER_PROMPTS[action[1]] + "\n«-» — убрать это условие."
+        )
+        return
+    await show_filter_menu(query, state)
+
+
+@router.message(Form.STATE_AUDIENCE_FILTER)
+@admin_required
+async def audience_filter_input(message: Message, state: FSMContext):
+    data = await state.get_data()
+    flt = AudienceFilter.from_dict(data.get("audience_filter"))
+    field = data.get("filter_field")
+    text = (message.text or "").strip()
+    clear = text == "-"
+    try:
+        if field == "tags":
+            flt.tags = [] if clear else [t.strip() for t in text.split(",") if t.strip()]
+        elif field == "resp":
+            flt.responsible_user_ids = [] if clear else [int(x) for x in re.split(r"[,\s]+", text) if x]
+        elif field in ("created", "updated"):
+            lo, hi = (None, None) if clear else parse_day_range(text)
+            setattr(flt, f"{field}_from", lo)
+            setattr(flt, f"{field}_to", hi)
+        elif field == "cf":
+            if clear:
+                flt.custom_fields = {}
+            else:
+                field_id, _, values = text.partition("=")
+                allowed = [v.strip() for v in values.split("|") if v.strip()]
+                if not allowed:
+                    raise ValueError("нет значений")
+                flt.custom_fields[int(field_id)] = allowed
+        else:
+            await state.set_state(Form.STATE_AUDIENCE)
+            return
+    except ValueError:
+        return await message.reply("❌ Не понял формат. " + FILTER_PROMPTS[field])
+    await state.update_data(audience_filter=flt.to_dict(), filter_field=None)
+    await ask_audience(message, state, pipeline_id=data.get("audience_pipeline"))
 
 
 # 1) Обработчик выбора аудитории: сохраняем список словарей {"phone", "name"}
@@ -1482,37 +1716,53 @@ def write_error_with_phone_check(lead_id, lead_name, phone, contact_name):
 async def cb_audience(query: CallbackQuery, state: FSMContext):
     await query.answer()
 
-    # Удаляем все JSON, кроме funnels.json
-    for f in AMOCRM_DIR.glob("*.json"):
-        if f.name != "funnels.json":
-            try:
-                f.unlink()
-            except Exception as e:
-                logger.warning("Не удалось удалить старый файл %s: %s", f, e)
-
-    # Если "Все этапы"
+    # Если "Все этапы": все несистемные этапы одним проходом по воронке
     if query.data == "aud:all":
+        data_state = await state.get_data()
+        by_pipeline: dict[int, list[int]] = {}
+        for status_id in data_state.get("funnel_map", {}).values():
+            info = crm_store.status(status_id)
+            if info and info["name"] not in SYSTEM_STAGES:
+                by_pipeline.setdefault(info["pipeline_id"], []).append(status_id)
+        if not by_pipeline:
+            await query.message.answer("❌ Не удалось определить этапы.")
+            return
+
+        flt = AudienceFilter.from_dict(data_state.get("audience_filter"))
+        if not flt.is_empty():
+            await query.message.edit_text(f"⏳ Загружаю аудиторию с фильтром ({flt.describe()})…")
+        elif not all(stage_sync.is_fresh(*sids) for sids in by_pipeline.values()):
+            await query.message.edit_text("⏳ Синхронизирую контакты всех этапов…")
         contacts = []
-        for file in AMOCRM_DIR.glob("*.json"):
-            if file.name == "funnels.json":
-                continue
-            try:
-                data = json.loads(file.read_text(encoding="utf-8"))
-                if data and isinstance(data[0], str):
-                    contacts.extend([{"phone": p, "name": "Клиент"} for p in data])
-                else:
-                    contacts.extend(data)
-            except Exception:
-                continue
+        seen_phones = set()
+        try:
+            audiences = await asyncio.gather(*(
+                load_audience(pipeline_id, status_ids, flt)
+                for pipeline_id, status_ids in by_pipeline.items()
+            ))
+            for audience in audiences:
+                for c in audience:
+                    if c["phone"] not in seen_phones:
+                        seen_phones.add(c["phone"])
+                        contacts.append(c)
+        except Exception as e:
+            await query.message.answer(f"❌ Ошибка при загрузке контактов: {e}")
+            return
+        if not contacts:
+            await query.message.answer("❌ Во всех этапах сделок нет.")
+            return
+        contacts, recent_line = drop_recent(contacts)
+        if not contacts:
+            await query.message.answer(f"❌ Все контакты этапов недавно получали сообщение.\n{recent_line}")
+            return
 
-        tmp = TEMP_CONTACTS_DIR / f"all_contacts_{uuid.uuid4().hex[:8]}.json"
-        tmp.write_text(json.dumps(contacts, ensure_ascii=False), encoding="utf-8")
-        
-        
-        await state.update_data(contacts=str(tmp))
-        
-        # Проверим что сохранилось
-        test_data = await state.get_data()
+        oldest = 0 if not flt.is_empty() else max(
+            stage_sync.data_age(sid) or 0 for sids in by_pipeline.values() for sid in sids
+        )
+        digest = audience_store.put(contacts)
+        await state.update_data(
+            contacts=str(audience_store.path(digest)), audience=digest, audience_label="Все этапы"
+        )
 
         cnt = len(contacts)
         min_secs = 40 * cnt
@@ -1522,6 +1772,9 @@ async def cb_audience(query: CallbackQuery, state: FSMContext):
 
         await query.message.edit_text(
             f"📊 Всего контактов: {cnt}\n"
+            f"{recent_line}"
+            f"{_filter_line(flt)}"
+            f"🕒 Данные amoCRM: {_format_age(oldest)}\n"
             f"⏳ Оценка длительности рассылки: от {min_hms} до {max_hms}\n"
             "⚠️ Продолжить?",
             reply_markup=InlineKeyboardMarkup(
@@ -1535,25 +1788,18 @@ async def cb_audience(query: CallbackQuery, state: FSMContext):
 
     # Если конкретная этап
     if query.data.startswith("aud:f"):
-        print("DEBUG: Выбран конкретный этап")
         data_state = await state.get_data()
         funnel_map = data_state.get("funnel_map", {})
         fid = query.data.split(":", 1)[1]
-        file_name = funnel_map.get(fid)
+        selected_status_id = funnel_map.get(fid)
         
-        print(f"DEBUG: fid = {fid}, file_name = {file_name}")
-
-        if not file_name:
-            await query.message.answer("❌ Не удалось определить файл статуса.")
-            return
+        logger.debug("Выбран этап: fid=%s, status_id=%s", fid, selected_status_id)
 
-        snap_path = AMOCRM_DIR / "funnels.json"
-        if not snap_path.exists():
-            await query.message.answer("❌ Файл funnels.json не найден.")
+        if not selected_status_id:
+            await query.message.answer("❌ Не удалось определить этап.")
             return
 
-        snap = json.loads(snap_path.read_text("utf-8"))
-        status_info = next((f for f in snap["funnels"] if f["file"] == file_name), None)
+        status_info = crm_store.status(selected_status_id)
 
         if not status_info:
             await query.message.answer("❌ Информация о статусе не найдена.")
@@ -1562,52 +1808,32 @@ async def cb_audience(query: CallbackQuery, state: FSMContext):
         status_name = status_info["name"]
         pipeline_id = status_info["pipeline_id"]
         status_id = status_info["status_id"]
-        local = AMOCRM_DIR / file_name
 
-        if not local.exists():
-            await query.message.edit_text("⏳ Скачиваю контакты…")
-            try:
-                leads = mgr.get_leads(pipeline_id, status_id)
-                if not leads:
-                    await query.message.answer(f"❌ В статусе '{status_name}' сделок нет.")
-                    return
-
-                cids = [c["id"] for l in leads for c in l["_embedded"]["contacts"]]
-                contacts_raw = mgr.get_contacts_bulk(cids)
-                contacts_data = []
-
-                for lead in leads:
-                    for c in lead["_embedded"]["contacts"]:
-                        co = contacts_raw.get(c["id"], {})
-                        phone_raw = mgr.extract_phone(co.get("custom_fields_values", []))
-                        name = co.get("name", "") or "Клиент"
-                        normalized = mgr.normalize_phone(phone_raw)
-
-                        if normalized:
-                            contacts_data.append({"phone": normalized, "name": name})
-                        else:
-                            write_error_with_phone_check(lead["id"], lead["name"], phone_raw, name)
-
-                # Уникализация
-                seen = set()
-                unique_contacts = []
-                for ct in contacts_data:
-                    if ct["phone"] not in seen:
-                        seen.add(ct["phone"])
-                        unique_contacts.append(ct)
-
-                local.write_text(json.dumps(unique_contacts, ensure_ascii=False), "utf-8")
-            except Exception as e:
-                await query.message.answer(f"❌ Ошибка при загрузке контактов: {e}")
-                return
-
-        contacts = json.loads(local.read_text("utf-8"))
-        tmp = TEMP_CONTACTS_DIR / f"{Path(file_name).stem}_{uuid.uuid4().hex[:8]}.json"
-        tmp.write_text(json.dumps(contacts, ensure_ascii=False), "utf-8")
-        
+        flt = AudienceFilter.from_dict(data_state.get("audience_filter"))
+        if not flt.is_empty():
+            await query.message.edit_text(f"⏳ Загружаю аудиторию с фильтром ({flt.describe()})…")
+        elif not stage_sync.is_fresh(status_id):
+            await query.message.edit_text("⏳ Синхронизирую контакты…")
+        try:
+            contacts = await load_audience(pipeline_id, [status_id], flt)
+        except Exception as e:
+            await query.message.answer(f"❌ Ошибка при загрузке контактов: {e}")
+            return
+        if not contacts:
+            await query.message.answer(f"❌ В статусе '{status_name}' сделок нет.")
+            return
+        contacts, recent_line = drop_recent(contacts)
+        if not contacts:
+            await query.message.answer(
+                f"❌ Все контакты статуса '{status_name}' недавно получали сообщение.\n{recent_line}"
+            )
+            return
 
-        
-        await state.update_data(contacts=str(tmp))
+        age = 0 if not flt.is_empty() else stage_sync.data_age(status_id)
+        digest = audience_store.put(contacts)
+        await state.update_data(
+            contacts=str(audience_store.path(digest)), audience=digest, audience_label=status_name
+        )
 
         
         # Проверим что сохранилось
@@ -1623,6 +1849,9 @@ async def cb_audience(query: CallbackQuery, state: FSMContext):
         await query.message.edit_text(
             f"✅ Статус: {status_name}\n"
             f"📊 Контактов: {cnt}\n"
+            f"{recent_line}"
+            f"{_filter_line(flt)}"
+            f"🕒 Данные amoCRM: {_format_age(age)}\n"
             f"⏳ Оценка длительности рассылки(часы, минуты, секунды): от {min_hms} до {max_hms}\n"
             "⚠️ Продолжить?",
             reply_markup=InlineKeyboardMarkup(
@@ -1635,93 +1864,6 @@ async def cb_audience(query: CallbackQuery, state: FSMContext):
         return
 
 
-    # Если конкретная этап
-    if query.data.startswith("aud:f"):
-        data_state = await state.get_data()
-        funnel_map = data_state.get("funnel_map", {})
-        fid = query.data.split(":", 1)[1]
-        file_name = funnel_map.get(fid)
-        if not file_name:
-            await query.message.answer("❌ Не удалось определить файл статуса.")
-            return
-
-        snap_path = AMOCRM_DIR / "funnels.json"
-        if not snap_path.exists():
-            await query.message.answer("❌ Файл funnels.json не найден.")
-            return
-        snap = json.loads(snap_path.read_text("utf-8"))
-
-        status_info = next((f for f in snap["funnels"] if f["file"] == file_name), None)
-        if not status_info:
-            await query.message.answer("❌ Информация о статусе не найдена.")
-            return
-
-        status_name = status_info["name"]
-        pipeline_id = status_info["pipeline_id"]
-        status_id = status_info["status_id"]
-        local = AMOCRM_DIR / file_name
-
-        if not local.exists():
-            await query.message.edit_text("⏳ Скачиваю контакты…")
-            try:
-                leads = mgr.get_leads(pipeline_id, status_id)
-                if not leads:
-                    await query.message.answer(f"❌ В статусе '{status_name}' сделок нет.")
-                    return
-
-                cids = [c["id"] for l in leads for c in l["_embedded"]["contacts"]]
-                contacts_raw = mgr.get_contacts_bulk(cids)
-
-                contacts_data = []
-                for lead in leads:
-                    for c in lead["_embedded"]["contacts"]:
-                        co = contacts_raw.get(c["id"], {})
-                        phone_raw = mgr.extract_phone(co.get("custom_fields_values", []))
-                        name = co.get("name", "") or "Клиент"
-                        normalized = mgr.normalize_phone(phone_raw)
-                        if normalized:
-                            contacts_data.append({"phone": normalized, "name": name})
-                        else:
-                            write_error_with_phone_check(lead["id"], lead["name"], phone_raw, name)
-
-                # Уникализация
-                seen = set()
-                unique_contacts = []
-                for ct in contacts_data:
-                    if ct["phone"] not in seen:
-                        seen.add(ct["phone"])
-                        unique_contacts.append(ct)
-
-                local.write_text(json.dumps(unique_contacts, ensure_ascii=False), "utf-8")
-            except Exception as e:
-                await query.message.answer(f"❌ Ошибка при загрузке контактов: {e}")
-                return
-
-        contacts = json.loads(local.read_text("utf-8"))
-        tmp = TEMP_CONTACTS_DIR / f"{Path(file_name).stem}_{uuid.uuid4().hex[:8]}.json"
-        tmp.write_text(json.dumps(contacts, ensure_ascii=False), "utf-8")
-        await state.update_data(contacts=str(tmp))
-
-        cnt = len(contacts)
-        min_secs = 40 * cnt
-        max_secs = 345 * cnt
-        min_hms = str(timedelta(seconds=min_secs))
-        max_hms = str(timedelta(seconds=max_secs))
-
-        await query.message.edit_text(
-            f"✅ Статус: {status_name}\n"
-            f"📊 Контактов: {cnt}\n"
-            f"⏳ Оценка длительности рассылки(часы, минуты, секунды): от {min_hms} до {max_hms}\n"
-            "⚠️ Продолжить?",
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Да", callback_data="aud_f_yes")],
-                    [InlineKeyboardButton(text="⬅️ Отмена", callback_data="aud_f_no")],
-                ]
-            ),
-        )
-        return
-
 # ---------------------------------------------------------------------------
 # выбор шаблона после аудитории
 async def send_templates_list(where: Message | CallbackQuery, state: FSMContext):
@@ -2061,39 +2203,10 @@ async def confirm_distribution(message: Message, state: FSMContext):
         await message.reply("❌ ОШИБКА: Файл контактов не найден. Попробуйте выбрать этап заново.")
         return
     
-    if contacts_file:
-        file_name = Path(contacts_file).stem
-        print(f"DEBUG: file_name = {file_name}")
-        
-        if "all_contacts" in file_name:
-            funnel_name = "Все этапы"
-            stage_info = "\n📊 Этап: Все этапы"
-            print(f"DEBUG: Detected all_contacts, funnel_name = {funnel_name}")
-        else:
-            snap_path = AMOCRM_DIR / "funnels.json"
-            if snap_path.exists():
-                try:
-                    snap = json.loads(snap_path.read_text("utf-8"))
-                    print(f"DEBUG: Found {len(snap.get('funnels', []))} funnels in funnels.json")
-                    
-                    for funnel in snap["funnels"]:
-                        print(f"DEBUG: Checking funnel file '{funnel['file']}' against '{file_name}'")
-                        
-                        # ИСПРАВЛЕНО: Правильная логика сопоставления
-                        funnel_file_base = Path(funnel["file"]).stem
-                        print(f"DEBUG: funnel_file_base = '{funnel_file_base}'")
-                        if funnel_file_base in file_name or file_name in funnel_file_base:
-                            funnel_name = funnel["name"]
-                            stage_info = f"\n📊 Этап: {funnel['name']}"
-                            print(f"DEBUG: MATCH! funnel_name = {funnel_name}")
-                            break
-                    else:
-                        print("DEBUG: No matching funnel found")
-                except Exception as e:
-                    print(f"DEBUG: Exception reading funnels.json: {e}")
-                    pass
-            else:
-                print("DEBUG: funnels.json not found")
+    # Имя аудитории сохраняется при выборе: файл снимка назван хешем содержимого
+    funnel_name = data.get("audience_label", "")
+    if funnel_name:
+        stage_info = f"\n📊 Этап: {funnel_name}"
     
     print(f"DEBUG: Final funnel_name = '{funnel_name}'")
     
@@ -2165,7 +2278,8 @@ async def cb_confirm(query: CallbackQuery, state: FSMContext):
         day_from=day_from,
         day_until=day_until,
         photo_file_id=data.get("photo_file_id"),
-        funnel_name=funnel_name
+        funnel_name=funnel_name,
+        audience=data.get("audience"),
     )
 
     # Форматируем время для пользователя
@@ -2246,15 +2360,15 @@ async def cb_job_detail(query: CallbackQuery, state: FSMContext):
     when = fmt_local(run_at)
 
     try:
-        contacts_count = len(
-            json.loads(Path(job["contacts"]).read_text(encoding="utf-8"))
-        )
+        contacts_count = count_contacts(job_contacts_path(job))
     except Exception:
         contacts_count = "неизвестно"
 
     # ДОБАВЛЕНО: получаем информацию о этапе
     funnel_name = job.get("funnel_name", "")
     funnel_info = f"\n📊 этап: {funnel_name}" if funnel_name else ""
+    if job.get("offset"):
+        funnel_info += f"\n📤 Отправлено: {job['offset']} из {contacts_count}"
     
     buttons = [
         [
@@ -2280,7 +2394,7 @@ async def cb_job_detail(query: CallbackQuery, state: FSMContext):
 async def cb_job_delete(query: CallbackQuery, state: FSMContext):
     await query.answer()
     job_id = query.data.split(":", 1)[1]
-    scheduled_store.remove(lambda x: x["job_id"] == job_id)
+    scheduled_store.delete(job_id)
     
     job_queue.jobs = [
         j
@@ -2288,6 +2402,7 @@ async def cb_job_delete(query: CallbackQuery, state: FSMContext):
         if j.get("data", {}).get("job_id") != job_id
     ]
     
+    cleanup_audiences()
     await query.message.edit_text(f"✅ Задача {job_id} удалена.")
     await state.set_state(Form.STATE_MENU)
 
@@ -2310,7 +2425,7 @@ async def cmd_cancel(message: Message, state: FSMContext):
 async def cmd_setup(message: Message, state: FSMContext):
     """Добавление первого админа"""
     user_id = message.from_user.id
-    if not admins_store.read():
+    if not admins_store:
         admins_store.append(user_id)
         await message.reply(f"✅ Вы добавлены как первый админ: {user_id}")
     else:
@@ -2319,11 +2434,37 @@ async def cmd_setup(message: Message, state: FSMContext):
 async def warmup_amocrm():
     global mgr
     try:
-        mgr = await asyncio.to_thread(AmoCRMCategoryManager) # не блокируем loop
+        await get_amocrm()  # открываем пул соединений; домен берётся из зеркала, если известен
         logger.info("✅ AmoCRM готов")
     except Exception as e:
         mgr = None
         logger.error("⚠️ AmoCRM недоступен: %s", e)
+
+async def start_amocrm_webhook():
+    """
+    Поднимает приёмник вебхуков amoCRM, если в conf.json есть секция "webhook":
+    {"host": "0.0.0.0", "port": 8081, "path": "/amocrm/webhook", "secret": "…"}.
+    URL для настройки в amoCRM: http://<host>:<port><path>?token=<secret>
+    """
+    try:
+        cfg = json.loads(CONF_FILE.read_text(encoding="utf-8")).get("webhook")
+    except Exception as e:
+        logger.warning("Не удалось прочитать conf.json для вебхуков: %s", e)
+        return None
+    if not cfg:
+        return None
+    receiver = WebhookReceiver(
+        crm_store,
+        path=cfg.get("path", "/amocrm/webhook"),
+        secret=cfg.get("secret"),
+        refresh=stage_sync.refresh_leads,
+        contact_cache=contact_cache,
+    )
+    try:
+        return await receiver.start(cfg.get("host", "0.0.0.0"), int(cfg.get("port", 8081)))
+    except OSError as e:
+        logger.error("⚠️ Приёмник вебхуков amoCRM не запущен: %s", e)
+        return None
 #--------------
 
 
@@ -2367,9 +2508,8 @@ async def handle_admin_add_input(message: Message, state: FSMContext):
     """Обработка ввода ID нового админа"""
     try:
         user_id = int(message.text.strip())
-        admins = admins_store.read()
-        
-        if user_id in admins:
+
+        if user_id in admins_store:
             await message.reply(
                 f"❌ Пользователь {user_id} уже является админом.",
                 reply_markup=InlineKeyboardMarkup(
@@ -2409,8 +2549,7 @@ async def cb_admin_delete(query: CallbackQuery, state: FSMContext):
     admin_id = int(query.data.split(":", 1)[1])
     
     # Проверяем, что это не единственный админ
-    admins = admins_store.read()
-    if len(admins) <= 1:
+    if len(admins_store) <= 1:
         await query.message.edit_text(
             "❌ Нельзя удалить единственного администратора.",
             reply_markup=InlineKeyboardMarkup(
@@ -2421,7 +2560,7 @@ async def cb_admin_delete(query: CallbackQuery, state: FSMContext):
         )
         return
     
-    admins_store.remove(lambda x: x == admin_id)
+    admins_store.delete(admin_id)
     await query.message.edit_text(
         f"✅ Администратор {admin_id} удален.",
         reply_markup=InlineKeyboardMarkup(
@@ -2525,9 +2664,12 @@ async def restore_scheduled_jobs():
             try:
                 run_at = datetime.fromisoformat(job["run_at"])
                 
+                # Начатую рассылку продолжаем сразу — с сохранённого offset
+                if run_at < current_time and (job.get("started_at") or job.get("offset")):
+                    run_at = current_time
                 # Удаляем просроченные задачи
-                if run_at < current_time:
-                    scheduled_store.remove(lambda x: x["job_id"] == job["job_id"])
+                elif run_at < current_time:
+                    scheduled_store.delete(job["job_id"])
                     expired_count += 1
                     logger.info(f"Удалена просроченная задача: {job['job_id']}")
                     continue
@@ -2548,6 +2690,7 @@ async def restore_scheduled_jobs():
                 logger.error(f"Ошибка восстановления задачи {job.get('job_id', 'unknown')}: {e}")
         
         logger.info(f"Восстановлено задач: {restored_count}, удалено просроченных: {expired_count}")
+        cleanup_audiences()
         
     except Exception as e:
         logger.exception(f"Ошибка при восстановлении задач: {e}")
@@ -2561,15 +2704,8 @@ async def main():
         logger.exception("Ошибка чтения token.json")
         raise RuntimeError("Проверьте содержимое token.json")
 
-    # Путь к файлу с ошибочными номерами
-    error_file = 'logs/Error_numbers.csv'
-    os.makedirs('logs', exist_ok=True)
-
-    # Пишем заголовки, если файл не существует или пуст
-    if not os.path.exists(error_file) or os.path.getsize(error_file) == 0:
-        with open(error_file, mode='w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['lead_id', 'lead_name', 'phone', 'contact_name'])
+    # Файл с ошибочными номерами: заголовок (или миграция старого формата)
+    error_registry.ensure_file()
 
     # Заголовки для логов доставки
     HEADERS = ["timestamp", "phone", "template_id", "funnel", "status", "response_info"]
@@ -2583,20 +2719,34 @@ async def main():
             writer.writerow(HEADERS)
 
     generate_delivery_stats_report(date_from="2025-07-20", date_to="2025-07-21")
+    # Индекс недавних доставок: дочитывается только хвост лога после контрольной точки
+    logger.info("Индекс доставок: прочитано новых строк %d", suppression.refresh())
 
     bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
     dp.include_router(router)
 
+    whatsapp_sender.start()
     asyncio.create_task(job_queue.process_jobs())
     asyncio.create_task(warmup_amocrm())
+    webhook_runner = await start_amocrm_webhook()
+    prefetch_task = start_stage_prefetcher()
     
     # ← ДОБАВИТЬ ЭТУ СТРОКУ
     await restore_scheduled_jobs()
     
     logger.info("🚀 Бот запущен.")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await whatsapp_sender.stop()
+        if prefetch_task is not None:
+            prefetch_task.cancel()
+        if webhook_runner is not None:
+            await webhook_runner.cleanup()
+        if mgr is not None:
+            await mgr.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
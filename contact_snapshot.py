@@ -0,0 +1,247 @@
+"""
+Компактный бинарный снимок аудитории (data/audiences/<хеш>.snap) вместо JSON.
+
+Колоночный формат, little-endian:
+    заголовок  16 байт: b"BCS1", версия u16, резерв u16, count u32, names_size u32
+    phones     count × u64 — цифры номера E.164 без «+»
+    offsets    (count + 1) × u32 — границы имён в блоке names
+    names      UTF-8 имён подряд
+
+Число контактов лежит в заголовке: `count_contacts` читает 16 байт.
+`ContactSnapshot` открывает файл через mmap — произвольный доступ и срезы
+по смещениям, итерация без разбора всего файла, память не растёт с размером аудитории.
+Файлы старого формата (JSON-список в temp_contacts/) по-прежнему читаются —
+для задач, запланированных до перехода.
+
+`AudienceStore` хранит снимки по хешу содержимого: одинаковые аудитории —
+один неизменяемый файл, задачи ссылаются на хеш, а снимки без ссылок
+из запланированных задач удаляются.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"BCS1"
+VERSION = 1
+SUFFIX = ".snap"
+
+_HEADER = struct.Struct("<4sHHII")
+_PHONE = struct.Struct("<Q")
+_OFFSET = struct.Struct("<I")
+
+
+def encode_snapshot(contacts: Iterable[dict]) -> bytes:
+    """
+    [{"phone": "+7…", "name": …}, …] → байты снимка.
+    ValueError — телефон не в формате E.164.
+    """
+    phones = bytearray()
+    offsets = bytearray(_OFFSET.pack(0))
+    names = bytearray()
+    count = 0
+    for c in contacts:
+        digits = str(c["phone"]).lstrip("+")
+        if not digits.isdigit() or not digits.isascii() or len(digits) > 15:
+            raise ValueError(f"Телефон не в формате E.164: {c['phone']!r}")
+        phones += _PHONE.pack(int(digits))
+        names += str(c.get("name") or "").encode("utf-8")
+        offsets += _OFFSET.pack(len(names))
+        count += 1
+    return b"".join((_HEADER.pack(MAGIC, VERSION, 0, count, len(names)), phones, offsets, names))
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def write_snapshot(path: Path, contacts: Iterable[dict]) -> int:
+    """Пишет контакты в снимок (атомарно, через .tmp). Возвращает их число."""
+    data = encode_snapshot(contacts)
+    _write_atomic(Path(path), data)
+    return _parse_header(data)[0]
+
+
+def is_snapshot(path: Path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def count_contacts(path: Path) -> int:
+    """Число контактов: из заголовка снимка или (старый формат) длина JSON-списка."""
+    with open(path, "rb") as f:
+        head = f.read(_HEADER.size)
+    if head[: len(MAGIC)] == MAGIC:
+        return _parse_header(head)[0]
+    return len(json.loads(Path(path).read_text("utf-8")))
+
+
+def _parse_header(head: bytes) -> tuple[int, int]:
+    if len(head) < _HEADER.size:
+        raise ValueError("Обрезанный снимок контактов")
+    magic, version, _, count, names_size = _HEADER.unpack_from(head)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Неизвестный формат снимка: {magic!r} v{version}")
+    return count, names_size
+
+
+class ContactSnapshot:
+    """
+    Снимок, открытый через mmap. Ведёт себя как последовательность
+    {"phone", "name"}: len(), индекс, срез, итерация.
+
+        with ContactSnapshot(path) as contacts:
+            total = len(contacts)
+            for c in contacts.iter_from(offset):
+                ...
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # пустой файл
+            self._file.close()
+            raise ValueError(f"Пустой снимок контактов: {self.path}") from None
+        self._view = memoryview(self._mm)
+        self.count, names_size = _parse_header(self._view[: _HEADER.size])
+        self._phones_at = _HEADER.size
+        self._offsets_at = self._phones_at + self.count * _PHONE.size
+        self._names_at = self._offsets_at + (self.count + 1) * _OFFSET.size
+        if len(self._mm) < self._names_at + names_size:
+            self.close()
+            raise ValueError(f"Обрезанный снимок контактов: {self.path}")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def phone(self, i: int) -> str:
+        return "+%d" % _PHONE.unpack_from(self._view, self._phones_at + i * _PHONE.size)[0]
+
+    def name(self, i: int) -> str:
+        at = self._offsets_at + i * _OFFSET.size
+        start = _OFFSET.unpack_from(self._view, at)[0]
+        end = _OFFSET.unpack_from(self._view, at + _OFFSET.size)[0]
+        return str(self._view[self._names_at + start : self._names_at + end], "utf-8")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return {"phone": self.phone(i), "name": self.name(i)}
+
+    def __iter__(self) -> Iterator[dict]:
+        return self.iter_from(0)
+
+    def iter_from(self, start: int) -> Iterator[dict]:
+        """Контакты начиная с `start` — без материализации остальных."""
+        for i in range(max(0, start), self.count):
+            yield {"phone": self.phone(i), "name": self.name(i)}
+
+    def close(self) -> None:
+        if self._mm is None:
+            return
+        self._view.release()
+        self._mm.close()
+        self._file.close()
+        self._mm = None
+
+    def __enter__(self) -> "ContactSnapshot":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class _ContactList(list):
+    """JSON-список старого формата с тем же интерфейсом, что у ContactSnapshot."""
+
+    def iter_from(self, start: int) -> Iterator[dict]:
+        return iter(self[max(0, start):])
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "_ContactList":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+def open_contacts(path: Path) -> ContactSnapshot | _ContactList:
+    """Снимок (mmap) или, для старых файлов, JSON-список контактов."""
+    if is_snapshot(path):
+        return ContactSnapshot(path)
+    return _ContactList(json.loads(Path(path).read_text("utf-8")))
+
+
+class AudienceStore:
+    """
+    Неизменяемые снимки аудиторий в `root/<хеш>.snap`, где хеш — sha256 содержимого.
+
+    `put` повторно не пишет уже существующую аудиторию. Ссылки держат
+    запланированные задачи (поле "audience"): `gc(refs)` удаляет снимки,
+    на которые не ссылается ни одна задача, если они старше `grace_seconds`.
+    Отсрочка оставляет время на выбор шаблона и времени: пока задача
+    не создана, на снимок ссылается только состояние диалога.
+    """
+
+    def __init__(self, root: Path, *, grace_seconds: float = 24 * 3600) -> None:
+        self.root = Path(root)
+        self.grace_seconds = grace_seconds
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest: str) -> Path:
+        return self.root / f"{digest}{SUFFIX}"
+
+    def put(self, contacts: Iterable[dict]) -> str:
+        """Сохраняет аудиторию, возвращает её хеш."""
+        data = encode_snapshot(contacts)
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        path = self.path(digest)
+        if path.exists():
+            os.utime(path)  # отсрочка gc считается от последнего выбора
+        else:
+            _write_atomic(path, data)
+        return digest
+
+    @staticmethod
+    def refcounts(refs: Iterable[str | None]) -> Counter:
+        return Counter(r for r in refs if r)
+
+    def gc(self, refs: Iterable[str | None]) -> int:
+        """Удаляет снимки без ссылок старше отсрочки. Возвращает число удалённых."""
+        counts = self.refcounts(refs)
+        deadline = time.time() - self.grace_seconds
+        removed = 0
+        for path in self.root.glob(f"*{SUFFIX}"):
+            if counts[path.stem]:
+                continue
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info("Удалено снимков аудиторий без ссылок: %d", removed)
+        return removed
@@ -0,0 +1,117 @@
+"""
+Фильтры аудитории поверх этапов amoCRM.
+
+То, что API v4 умеет фильтровать само (`filter[responsible_user_id]`,
+`filter[created_at]`, `filter[updated_at]`), уходит параметрами запроса `/leads` —
+лишние сделки даже не качаются. Теги и дополнительные поля API v4 в списке
+сделок не фильтрует, поэтому они проверяются в потоке по пришедшим страницам
+(теги и значения полей приходят в самих сделках без лишних запросов).
+"""
+
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+
+
+@dataclass
+class AudienceFilter:
+    tags: list[str] = field(default_factory=list)  # хотя бы один из тегов
+    responsible_user_ids: list[int] = field(default_factory=list)
+    created_from: int | None = None  # unix-время, границы включительно
+    created_to: int | None = None
+    updated_from: int | None = None
+    updated_to: int | None = None
+    # field_id → допустимые значения (хотя бы одно, без учёта регистра)
+    custom_fields: dict[int, list[str]] = field(default_factory=dict)
+
+    # ------------------------------------------------------------------
+    # Хранение в состоянии FSM
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["custom_fields"] = {str(k): v for k, v in self.custom_fields.items()}
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> "AudienceFilter":
+        data = dict(data or {})
+        data["custom_fields"] = {int(k): v for k, v in (data.get("custom_fields") or {}).items()}
+        return cls(**data)
+
+    def is_empty(self) -> bool:
+        return self == AudienceFilter()
+
+    # ------------------------------------------------------------------
+    def to_params(self) -> dict:
+        """Часть фильтра, которую выполняет сам amoCRM: параметры запроса `/leads`."""
+        params: dict = {}
+        for i, uid in enumerate(self.responsible_user_ids):
+            params[f"filter[responsible_user_id][{i}]"] = uid
+        for name in ("created", "updated"):
+            lo, hi = getattr(self, f"{name}_from"), getattr(self, f"{name}_to")
+            if lo is not None:
+                params[f"filter[{name}_at][from]"] = lo
+            if hi is not None:
+                params[f"filter[{name}_at][to]"] = hi
+        return params
+
+    def match(self, lead: dict) -> bool:
+        """Остаток фильтра, который проверяется на сделке в потоке."""
+        if self.tags:
+            wanted = {t.casefold() for t in self.tags}
+            names = {
+                str(t.get("name", "")).casefold()
+                for t in lead.get("_embedded", {}).get("tags") or []
+            }
+            if not wanted & names:
+                return False
+        if self.custom_fields:
+            values: dict[int, set[str]] = {}
+            for fld in lead.get("custom_fields_values") or []:
+                values[fld.get("field_id")] = {
+                    str(v.get("value", "")).casefold() for v in fld.get("values") or []
+                }
+            for field_id, allowed in self.custom_fields.items():
+                if not values.get(field_id, set()) & {a.casefold() for a in allowed}:
+                    return False
+        return True
+
+    def describe(self) -> str:
+        """Человекочитаемое описание для сообщений бота."""
+        parts = []
+        if self.tags:
+            parts.append("теги: " + ", ".join(self.tags))
+        if self.responsible_user_ids:
+            parts.append("ответственный: " + ", ".join(map(str, self.responsible_user_ids)))
+        for name, title in (("created", "создана"), ("updated", "изменена")):
+            lo, hi = getattr(self, f"{name}_from"), getattr(self, f"{name}_to")
+            if lo is not None or hi is not None:
+                parts.append(f"{title}: {_fmt_day(lo)}–{_fmt_day(hi)}")
+        for field_id, allowed in self.custom_fields.items():
+            parts.append(f"поле {field_id}: " + " | ".join(allowed))
+        return "; ".join(parts) if parts else "без фильтров"
+
+
+def _fmt_day(ts: int | None) -> str:
+    return datetime.fromtimestamp(ts).strftime("%d.%m.%Y") if ts is not None else "…"
+
+
+def parse_day_range(text: str) -> tuple[int | None, int | None]:
+    """
+    «01.07.2025–31.07.2025», «01.07.2025–» или «–31.07.2025» (местное время)
+    → (начало первого дня, конец последнего дня) в unix-времени.
+    ValueError, если формат не распознан или границы перепутаны.
+    """
+    left, sep, right = text.replace("—", "-").replace("–", "-").partition("-")
+    if not sep:
+        left = right = text
+    lo = hi = None
+    if left.strip():
+        lo = int(datetime.strptime(left.strip(), "%d.%m.%Y").timestamp())
+    if right.strip():
+        hi = int((datetime.strptime(right.strip(), "%d.%m.%Y") + timedelta(days=1)).timestamp()) - 1
+    if lo is None and hi is None:
+        raise ValueError("пустой период")
+    if lo is not None and hi is not None and lo > hi:
+        raise ValueError("начало позже конца")
+    return lo, hi
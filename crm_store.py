@@ -0,0 +1,459 @@
+"""
+Локальное зеркало amoCRM в SQLite: этапы, сделки, контакты и нормализованные телефоны.
+
+Аудитория этапа (или нескольких этапов) — один индексированный запрос
+вместо чтения/копирования JSON-файлов по этапам.
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pipelines (
+    id   INTEGER PRIMARY KEY,
+    name TEXT    NOT NULL,
+    sort INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS statuses (
+    id          INTEGER PRIMARY KEY,
+    pipeline_id INTEGER NOT NULL,
+    name        TEXT    NOT NULL,
+    sort        INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS leads (
+    id          INTEGER PRIMARY KEY,
+    pipeline_id INTEGER NOT NULL,
+    status_id   INTEGER NOT NULL,
+    name        TEXT    NOT NULL DEFAULT '',
+    updated_at  INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS leads_stage ON leads (pipeline_id, status_id);
+CREATE TABLE IF NOT EXISTS lead_contacts (
+    lead_id    INTEGER NOT NULL,
+    contact_id INTEGER NOT NULL,
+    PRIMARY KEY (lead_id, contact_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS lead_contacts_contact ON lead_contacts (contact_id);
+CREATE TABLE IF NOT EXISTS contacts (
+    id         INTEGER PRIMARY KEY,
+    name       TEXT NOT NULL DEFAULT '',
+    fetched_at REAL NOT NULL DEFAULT 0
+);
+-- phone — E.164 или NULL, если номер не прошёл нормализацию
+CREATE TABLE IF NOT EXISTS phones (
+    contact_id INTEGER PRIMARY KEY,
+    raw        TEXT NOT NULL DEFAULT '',
+    phone      TEXT
+);
+CREATE INDEX IF NOT EXISTS phones_phone ON phones (phone);
+CREATE TABLE IF NOT EXISTS synced_stages (
+    status_id   INTEGER PRIMARY KEY,
+    pipeline_id INTEGER NOT NULL,
+    full_at     REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+-- сырые объекты контактов amoCRM (с custom_fields_values) для ContactCache
+CREATE TABLE IF NOT EXISTS contact_cache (
+    id         INTEGER PRIMARY KEY,
+    payload    TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contact_cache_age ON contact_cache (fetched_at);
+-- сделки, встреченные текущей полной синхронизацией этапа (живёт до закрытия соединения)
+CREATE TEMP TABLE IF NOT EXISTS stage_seen (
+    status_id INTEGER NOT NULL,
+    lead_id   INTEGER NOT NULL,
+    PRIMARY KEY (status_id, lead_id)
+) WITHOUT ROWID;
+"""
+
+
+class CRMStore:
+    """Тонкая обёртка над sqlite3 с операциями, нужными синхронизации и боту."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    # ------------------------------------------------------------------
+    # meta: произвольные значения (high-water mark, время синхронизации…)
+    def get_meta(self, key: str, default: str | None = None) -> str | None:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value) -> None:
+        self.db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value)),
+        )
+
+    # ------------------------------------------------------------------
+    # Воронки и этапы
+    def replace_pipelines(self, pipelines: list[tuple[int, str]]) -> None:
+        """Перезаписывает список отслеживаемых воронок; этапы остальных удаляются."""
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM pipelines")
+            self.db.executemany(
+                "INSERT INTO pipelines (id, name, sort) VALUES (?, ?, ?)",
+                [(pid, name, i) for i, (pid, name) in enumerate(pipelines)],
+            )
+            self.db.execute("DELETE FROM statuses WHERE pipeline_id NOT IN (SELECT id FROM pipelines)")
+
+    def pipelines(self) -> list[dict]:
+        """[{"pipeline_id", "name"}] в порядке из конфигурации."""
+        return [
+            {"pipeline_id": pid, "name": name}
+            for pid, name in self.db.execute("SELECT id, name FROM pipelines ORDER BY sort")
+        ]
+
+    def replace_statuses(self, pipeline_id: int, statuses: list[tuple[int, str]]) -> None:
+        """
+        Перезаписывает список этапов воронки в исходном порядке.
+        Системные 142/143 общие для всех воронок и хранятся один раз —
+        в аудитории они всё равно не попадают.
+        """
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM statuses WHERE pipeline_id = ?", (pipeline_id,))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO statuses (id, pipeline_id, name, sort) VALUES (?, ?, ?, ?)",
+                [(sid, pipeline_id, name, i) for i, (sid, name) in enumerate(statuses)],
+            )
+
+    def statuses(self, pipeline_id: int | None = None) -> list[dict]:
+        """Этапы с числом сделок в зеркале: [{"pipeline_id", "status_id", "name", "leads"}]."""
+        sql = (
+            "SELECT s.pipeline_id, s.id, s.name, "
+            "(SELECT COUNT(*) FROM leads l WHERE l.pipeline_id = s.pipeline_id AND l.status_id = s.id) "
+            "FROM statuses s"
+        )
+        args: tuple = ()
+        if pipeline_id is not None:
+            sql += " WHERE s.pipeline_id = ?"
+            args = (pipeline_id,)
+        sql += " ORDER BY s.pipeline_id, s.sort"
+        return [
+            {"pipeline_id": p, "status_id": s, "name": n, "leads": c}
+            for p, s, n, c in self.db.execute(sql, args)
+        ]
+
+    def status(self, status_id: int) -> dict | None:
+        row = self.db.execute(
+            "SELECT pipeline_id, id, name FROM statuses WHERE id = ?", (status_id,)
+        ).fetchone()
+        return {"pipeline_id": row[0], "status_id": row[1], "name": row[2]} if row else None
+
+    # ------------------------------------------------------------------
+    # Синхронизированные этапы
+    def stage_full_at(self, status_id: int) -> float | None:
+        row = self.db.execute(
+            "SELECT full_at FROM synced_stages WHERE status_id = ?", (status_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def synced_status_ids(self) -> set[int]:
+        return {r[0] for r in self.db.execute("SELECT status_id FROM synced_stages")}
+
+    def mark_stage_synced(self, pipeline_id: int, status_id: int, full_at: float) -> None:
+        self.db.execute(
+            "INSERT INTO synced_stages (status_id, pipeline_id, full_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(status_id) DO UPDATE SET pipeline_id = excluded.pipeline_id, "
+            "full_at = excluded.full_at",
+            (status_id, pipeline_id, full_at),
+        )
+
+    # ------------------------------------------------------------------
+    # Сделки
+    # Полная синхронизация этапа идёт постранично:
+    #   begin_stage_refresh → upsert_leads(page, mark_seen=True) × N → finish_stage_refresh,
+    # и в конце удаляются сделки этапа, которых в выгрузке не оказалось.
+    def begin_stage_refresh(self, status_id: int) -> None:
+        self.db.execute("DELETE FROM stage_seen WHERE status_id = ?", (status_id,))
+
+    def finish_stage_refresh(self, pipeline_id: int, status_id: int) -> None:
+        """Удаляет сделки этапа, не встреченные с begin_stage_refresh."""
+        stale = (
+            "SELECT id FROM leads WHERE pipeline_id = ? AND status_id = ? "
+            "AND id NOT IN (SELECT lead_id FROM stage_seen WHERE status_id = ?)"
+        )
+        args = (pipeline_id, status_id, status_id)
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(f"DELETE FROM lead_contacts WHERE lead_id IN ({stale})", args)
+            self.db.execute(f"DELETE FROM leads WHERE id IN ({stale})", args)
+            self.db.execute("DELETE FROM stage_seen WHERE status_id = ?", (status_id,))
+
+    def upsert_leads(self, leads: list[dict], *, mark_seen: bool = False) -> None:
+        """
+        Вставляет/обновляет сделки (этап берётся из самой сделки).
+        `mark_seen` — отметить сделки как встреченные полной синхронизацией их этапа.
+        """
+        with self.db:
+            self.db.execute("BEGIN")
+            self._upsert_leads(leads)
+            if mark_seen:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO stage_seen (status_id, lead_id) VALUES (?, ?)",
+                    [(lead.get("status_id") or 0, lead["id"]) for lead in leads],
+                )
+
+    def _upsert_leads(self, leads: list[dict]) -> None:
+        self.db.executemany(
+            "INSERT INTO leads (id, pipeline_id, status_id, name, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+            "pipeline_id = excluded.pipeline_id, status_id = excluded.status_id, "
+            "name = excluded.name, updated_at = excluded.updated_at",
+            [
+                (
+                    lead["id"],
+                    lead.get("pipeline_id") or 0,
+                    lead.get("status_id") or 0,
+                    lead.get("name") or "",
+                    lead.get("updated_at") or 0,
+                )
+                for lead in leads
+            ],
+        )
+        self.db.executemany(
+            "DELETE FROM lead_contacts WHERE lead_id = ?", [(lead["id"],) for lead in leads]
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO lead_contacts (lead_id, contact_id) VALUES (?, ?)",
+            [
+                (lead["id"], c["id"])
+                for lead in leads
+                for c in lead.get("_embedded", {}).get("contacts", [])
+            ],
+        )
+
+    def move_leads(self, rows: Iterable[tuple[int, int, int, int]]) -> None:
+        """Смена этапа известных сделок без изменения их контактов: (id, pipeline_id, status_id, updated_at)."""
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "UPDATE leads SET pipeline_id = ?, status_id = ?, "
+                "updated_at = MAX(updated_at, ?) WHERE id = ?",
+                [(pid, sid, upd, lid) for lid, pid, sid, upd in rows],
+            )
+
+    def delete_leads(self, lead_ids: Iterable[int]) -> None:
+        ids = [(i,) for i in lead_ids]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM lead_contacts WHERE lead_id = ?", ids)
+            self.db.executemany("DELETE FROM leads WHERE id = ?", ids)
+
+    def existing_lead_ids(self, lead_ids: Iterable[int]) -> set[int]:
+        ids = list(lead_ids)
+        found: set[int] = set()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            marks = ",".join("?" * len(chunk))
+            found.update(
+                r[0] for r in self.db.execute(f"SELECT id FROM leads WHERE id IN ({marks})", chunk)
+            )
+        return found
+
+    # ------------------------------------------------------------------
+    # Контакты и телефоны
+    def linked_contact_ids(self, contact_ids: Iterable[int]) -> set[int]:
+        """Какие из контактов привязаны к сделкам зеркала."""
+        ids = list(contact_ids)
+        found: set[int] = set()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            marks = ",".join("?" * len(chunk))
+            found.update(
+                r[0]
+                for r in self.db.execute(
+                    f"SELECT DISTINCT contact_id FROM lead_contacts WHERE contact_id IN ({marks})",
+                    chunk,
+                )
+            )
+        return found
+
+    def delete_contacts(self, contact_ids: Iterable[int]) -> None:
+        ids = [(i,) for i in contact_ids]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM lead_contacts WHERE contact_id = ?", ids)
+            self.db.executemany("DELETE FROM phones WHERE contact_id = ?", ids)
+            self.db.executemany("DELETE FROM contacts WHERE id = ?", ids)
+
+    def upsert_contacts(self, rows: Iterable[tuple[int, str, str, str | None]]) -> None:
+        """rows: (contact_id, name, raw_phone, normalized_phone | None)."""
+        rows = list(rows)
+        now = time.time()
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO contacts (id, name, fetched_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET name = excluded.name, fetched_at = excluded.fetched_at",
+                [(cid, name, now) for cid, name, _, _ in rows],
+            )
+            self.db.executemany(
+                "INSERT INTO phones (contact_id, raw, phone) VALUES (?, ?, ?) "
+                "ON CONFLICT(contact_id) DO UPDATE SET raw = excluded.raw, phone = excluded.phone",
+                [(cid, raw, phone) for cid, _, raw, phone in rows],
+            )
+
+    # ------------------------------------------------------------------
+    # Аудитории
+    def audience(self, pipeline_id: int, status_ids: Iterable[int]) -> list[dict]:
+        """
+        Уникальные по телефону контакты сделок указанных этапов воронки:
+        [{"phone", "name"}, …] в порядке сделок. Один запрос по индексам.
+        Если у телефона несколько контактов, имя — наименьшее непустое из них,
+        чтобы выборка не зависела от плана запроса.
+        """
+        status_ids = list(status_ids)
+        if not status_ids:
+            return []
+        marks = ",".join("?" * len(status_ids))
+        rows = self.db.execute(
+            f"""
+            SELECT p.phone, MIN(NULLIF(c.name, ''))
+            FROM leads l
+            JOIN lead_contacts lc ON lc.lead_id = l.id
+            JOIN phones p ON p.contact_id = lc.contact_id
+            JOIN contacts c ON c.id = lc.contact_id
+            WHERE l.pipeline_id = ? AND l.status_id IN ({marks}) AND p.phone IS NOT NULL
+            GROUP BY p.phone
+            ORDER BY MIN(l.id)
+            """,
+            (pipeline_id, *status_ids),
+        )
+        return [{"phone": phone, "name": name or "Клиент"} for phone, name in rows]
+
+
+class ContactCache:
+    """
+    Кэш контактов amoCRM по id с TTL и LRU-вытеснением.
+
+    В памяти — до `max_size` последних использованных контактов, на диске
+    (таблица `contact_cache` зеркала) — столько же самых свежих, поэтому кэш
+    переживает перезапуск. Один контакт из нескольких этапов качается один раз.
+    """
+
+    def __init__(self, store: CRMStore, *, ttl: float = 6 * 3600, max_size: int = 50_000) -> None:
+        self.db = store.db
+        self.ttl = ttl
+        self.max_size = max_size
+        self._mem: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def stats(self) -> dict:
+        """Счётчики для подбора TTL и размера."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "in_memory": len(self._mem),
+        }
+
+    def get_many(self, ids: Iterable[int]) -> tuple[dict[int, dict], list[int]]:
+        """({id: контакт} для свежих попаданий, [id, которые нужно скачать])."""
+        now = time.time()
+        found: dict[int, dict] = {}
+        missing: list[int] = []
+        cold: list[int] = []
+        for cid in dict.fromkeys(ids):
+            entry = self._mem.get(cid)
+            if entry is None:
+                cold.append(cid)
+            elif now - entry[0] < self.ttl:
+                self._mem.move_to_end(cid)
+                found[cid] = entry[1]
+            else:
+                self.stale += 1
+                del self._mem[cid]
+                missing.append(cid)
+
+        # Промахи памяти — одним запросом к диску
+        for i in range(0, len(cold), 500):
+            chunk = cold[i : i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = {
+                cid: (fetched_at, payload)
+                for cid, payload, fetched_at in self.db.execute(
+                    f"SELECT id, payload, fetched_at FROM contact_cache WHERE id IN ({marks})",
+                    chunk,
+                )
+            }
+            for cid in chunk:
+                row = rows.get(cid)
+                if row is None:
+                    missing.append(cid)
+                elif now - row[0] >= self.ttl:
+                    self.stale += 1
+                    missing.append(cid)
+                else:
+                    contact = json.loads(row[1])
+                    self._remember(cid, row[0], contact)
+                    found[cid] = contact
+
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, contacts: Iterable[dict]) -> None:
+        now = time.time()
+        rows = []
+        for contact in contacts:
+            self._remember(contact["id"], now, contact)
+            rows.append((contact["id"], json.dumps(contact, ensure_ascii=False), now))
+        if not rows:
+            return
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO contact_cache (id, payload, fetched_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET payload = excluded.payload, "
+                "fetched_at = excluded.fetched_at",
+                rows,
+            )
+            # Держим на диске не больше max_size самых свежих записей
+            self.db.execute(
+                "DELETE FROM contact_cache WHERE id IN (SELECT id FROM contact_cache "
+                "ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+
+    def invalidate(self, ids: Iterable[int]) -> None:
+        """Выбросить контакты (например, после вебхука об их изменении)."""
+        ids = list(ids)
+        if not ids:
+            return
+        for cid in ids:
+            self._mem.pop(cid, None)
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM contact_cache WHERE id = ?", [(i,) for i in ids])
+
+    def _remember(self, cid: int, fetched_at: float, contact: dict) -> None:
+        self._mem[cid] = (fetched_at, contact)
+        self._mem.move_to_end(cid)
+        while len(self._mem) > self.max_size:
+            self._mem.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,410 @@
+"""
+Инкрементальная синхронизация этапов amoCRM в локальное зеркало (crm_store.CRMStore).
+
+Этап впервые (или раз в сутки) качается целиком. Дальше зеркало держится
+в актуальном состоянии одной общей «дельтой»: сделки аккаунта, изменённые
+после high-water mark (`filter[updated_at][from]`), применяются как дифф:
+• сделка сменила этап/воронку или закрыта → у неё просто меняется status_id
+• удалённая сделка → удаляется из зеркала
+• новая сделка в синхронизированном этапе → добавляется вместе с контактами
+Если дельта запрашивалась совсем недавно, сеть не трогаем вовсе.
+Несколько этапов («Все этапы») качаются параллельно, каждый своим потоком
+страниц, под общим лимитом запросов клиента; время каждого этапа пишется в лог.
+
+Выгрузка потоковая: каждая пришедшая страница сделок сразу уходит на
+докачку контактов и в зеркало, пока следующие страницы ещё качаются.
+В полёте не больше `contact_concurrency` страниц, поэтому память
+ограничена окном, а не размером этапа.
+
+Аудитория с фильтрами (crm_filters.AudienceFilter) качается мимо сделок
+зеркала: фильтр уходит параметрами запроса, остаток проверяется на страницах,
+а телефоны собираются прямо в потоке. Сделки и отметки синхронизации этапов
+она не меняет, но докачанные контакты и их телефоны записывает в зеркало
+(таблицы contacts и phones), как и обычная выгрузка.
+
+StagePrefetcher держит зеркало тёплым в фоне: периодически обновляет список
+этапов и прогоняет все несистемные этапы, уступая место интерактивным кликам.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Coroutine
+
+from amocrm_client import AmoCRMClient
+from crm_filters import AudienceFilter
+from crm_store import CRMStore
+
+logger = logging.getLogger(__name__)
+
+
+class StageSync:
+    """Синхронизация этапов в зеркало и выдача аудиторий из него."""
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Awaitable[AmoCRMClient]],
+        store: CRMStore,
+        *,
+        fresh_seconds: float = 60,
+        full_resync_seconds: float = 24 * 3600,
+        contact_concurrency: int = 3,
+        on_bad_phone: Callable[[dict, str, str], None] | None = None,
+        on_download_done: Callable[[], None] | None = None,
+    ) -> None:
+        """
+        `fresh_seconds` — сколько секунд зеркало считается свежим без запроса дельты.
+        `full_resync_seconds` — как часто всё же перекачивать этап целиком
+        (удалённые в amoCRM сделки через `updated_at` не видны).
+        `contact_concurrency` — сколько страниц сделок одновременно докачивают контакты.
+        `on_bad_phone(lead, phone_raw, name)` — вызывается для невалидных номеров.
+        `on_download_done()` — после каждой выгрузки из amoCRM (сбросить буферы на диск).
+        """
+        self._client_factory = client_factory
+        self.store = store
+        self.fresh_seconds = fresh_seconds
+        self.full_resync_seconds = full_resync_seconds
+        self.contact_concurrency = max(1, contact_concurrency)
+        self._on_bad_phone = on_bad_phone
+        self._on_download_done = on_download_done
+        # Синхронизации одной воронки идут по одной: клик, пришедший во время
+        # фонового прогрева, дожидается его и получает уже тёплые данные.
+        # Разные воронки синхронизируются параллельно, общая дельта — одна за раз.
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._delta_lock = asyncio.Lock()
+        self.last_interactive = 0.0  # time.monotonic() последнего запроса админа
+        self.stage_timings: dict[int, float] = {}  # status_id → секунды последней полной выгрузки
+
+    # ------------------------------------------------------------------
+    def _needs_full(self, status_id: int) -> bool:
+        full_at = self.store.stage_full_at(status_id)
+        return full_at is None or time.time() - full_at > self.full_resync_seconds
+
+    def _needs_delta(self) -> bool:
+        last = float(self.store.get_meta("delta_at", "0"))
+        return time.time() - last >= self.fresh_seconds
+
+    def is_fresh(self, *status_ids: int) -> bool:
+        """True, если выбор этапов обойдётся без сетевых запросов."""
+        return not any(map(self._needs_full, status_ids)) and not self._needs_delta()
+
+    def data_age(self, status_id: int) -> float | None:
+        """Сколько секунд назад данные этапа сверялись с amoCRM; None — ещё не качался."""
+        full_at = self.store.stage_full_at(status_id)
+        if full_at is None:
+            return None
+        return time.time() - max(full_at, float(self.store.get_meta("delta_at", "0")))
+
+    # ------------------------------------------------------------------
+    async def sync_stage(self, pipeline_id: int, status_id: int) -> list[dict]:
+        """Синхронизирует этап и возвращает его аудиторию [{"phone", "name"}, …]."""
+        return await self.sync_stages(pipeline_id, [status_id])
+
+    async def sync_stages(
+        self, pipeline_id: int, status_ids: list[int], *, background: bool = False
+    ) -> list[dict]:
+        """
+        Синхронизирует этапы воронки и возвращает их общую аудиторию
+        (уникальную по телефону). Этапы без свежей полной выгрузки
+        качаются параллельно (`_full_sync`), остальные догоняются дельтой.
+        Время последней полной выгрузки по этапам — в `stage_timings`.
+        `background` — вызов прогревателя, а не админа.
+        """
+        if not background:
+            self.last_interactive = time.monotonic()
+        async with self._locks.setdefault(pipeline_id, asyncio.Lock()):
+            try:
+                stale = [sid for sid in status_ids if self._needs_full(sid)]
+                if stale:
+                    self.stage_timings.update(await self._full_sync(pipeline_id, stale))
+                if len(stale) < len(status_ids):
+                    async with self._delta_lock:
+                        if self._needs_delta():
+                            await self.delta_sync()
+            finally:
+                self._download_done()
+        return self.store.audience(pipeline_id, status_ids)
+
+    async def filtered_audience(
+        self, pipeline_id: int, status_ids: list[int], flt: AudienceFilter
+    ) -> list[dict]:
+        """
+        Аудитория этапов с фильтром [{"phone", "name"}, …] — сразу из amoCRM.
+        Сделки приходят уже отфильтрованными по ответственному и датам,
+        теги и доп. поля проверяются на каждой странице до докачки контактов.
+        """
+        self.last_interactive = time.monotonic()
+        client = await self._client_factory()
+        started = time.time()
+        seen_contacts: set[int] = set()
+        pages: list[list[tuple[int, str, str, str | None]]] = []
+        pending: set[asyncio.Task] = set()
+        total = matched = 0
+
+        async def collect(slot: int, leads: list[dict]) -> None:
+            pages[slot] = await self._store_contacts(client, leads, seen_contacts)
+
+        try:
+            async for page in client.iter_stages_lead_pages(
+                pipeline_id, status_ids, flt.to_params()
+            ):
+                total += len(page)
+                leads = [l for l in page if flt.match(l)]
+                if not leads:
+                    continue
+                matched += len(leads)
+                pages.append([])
+                await self._submit(pending, collect(len(pages) - 1, leads))
+            await asyncio.gather(*pending)
+        finally:
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self._download_done()
+
+        audience: list[dict] = []
+        phones: set[str] = set()
+        for rows in pages:
+            for _, name, _, phone in rows:
+                if phone and phone not in phones:
+                    phones.add(phone)
+                    audience.append({"phone": phone, "name": name})
+        logger.info(
+            "Аудитория с фильтром (%s): %d/%d сделок, %d телефонов за %.2f с",
+            flt.describe(), matched, total, len(audience), time.time() - started,
+        )
+        return audience
+
+    async def _full_sync(self, pipeline_id: int, status_ids: list[int]) -> dict[int, float]:
+        """
+        Полная выгрузка этапов: каждый этап — свой поток страниц, этапы качаются
+        параллельно (запросы делят общий лимит клиента `max_concurrency`),
+        поэтому «Все этапы» занимают примерно столько, сколько самый долгий этап.
+        Возвращает {status_id: секунды на этап}.
+        """
+        client = await self._client_factory()
+        started = time.time()
+        seen_contacts: set[int] = set()
+        for sid in status_ids:
+            self.store.begin_stage_refresh(sid)
+
+        async def one(status_id: int) -> tuple[int, float]:
+            stage_started = time.perf_counter()
+            count = 0
+            pending: set[asyncio.Task] = set()
+            try:
+                async for page in client.iter_lead_pages(pipeline_id, status_id):
+                    count += len(page)
+                    await self._submit(
+                        pending, self._store_page(client, page, seen_contacts, mark_seen=True)
+                    )
+                await asyncio.gather(*pending)
+            finally:
+                for t in pending:
+                    t.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            return count, time.perf_counter() - stage_started
+
+        tasks = [asyncio.create_task(one(sid)) for sid in status_ids]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        timings = {sid: seconds for sid, (_, seconds) in zip(status_ids, results)}
+        for sid in status_ids:
+            self.store.finish_stage_refresh(pipeline_id, sid)
+            self.store.mark_stage_synced(pipeline_id, sid, started)
+        # Отметка — начало выгрузки (с запасом), а не максимальный updated_at
+        # в ней: сделку с ранней страницы могли перенести, пока качались
+        # поздние, и такой перенос должна подхватить первая же дельта
+        current = self.store.get_meta("hwm")
+        if current is None:
+            self.store.set_meta("hwm", int(started) - 60)
+            self.store.set_meta("delta_at", started)
+        elif int(current) > int(started) - 60:
+            # Пока этап качался, параллельная дельта ушла вперёд, пропустив
+            # его сделки (этап ещё не считался синхронизированным) — откатываем
+            self.store.set_meta("hwm", int(started) - 60)
+        for sid, (count, seconds) in zip(status_ids, results):
+            logger.info("Этап %s: %d сделок за %.2f с", sid, count, seconds)
+        logger.info(
+            "Этапы %s: полная синхронизация, %d сделок за %.2f с",
+            status_ids, sum(count for count, _ in results), time.time() - started,
+        )
+        return timings
+
+    async def delta_sync(self) -> None:
+        """Применяет к зеркалу все сделки, изменённые после high-water mark."""
+        client = await self._client_factory()
+        started = time.time()
+        hwm = int(self.store.get_meta("hwm", "0"))
+        synced = self.store.synced_status_ids()
+        changed = deleted = 0
+        seen_contacts: set[int] = set()
+        pending: set[asyncio.Task] = set()
+        try:
+            async for page in client.iter_updated_lead_pages(hwm):
+                known = self.store.existing_lead_ids(l["id"] for l in page)
+                gone: list[int] = []
+                keep: list[dict] = []
+                for lead in page:
+                    hwm = max(hwm, lead.get("updated_at") or 0)
+                    if lead.get("is_deleted"):
+                        gone.append(lead["id"])
+                    elif lead["id"] in known or lead.get("status_id") in synced:
+                        keep.append(lead)
+                if gone:
+                    self.store.delete_leads(gone)
+                    deleted += len(gone)
+                if keep:
+                    changed += len(keep)
+                    await self._submit(pending, self._store_page(client, keep, seen_contacts))
+            await asyncio.gather(*pending)
+        finally:
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.store.set_meta("hwm", hwm)
+        self.store.set_meta("delta_at", started)
+        logger.info("Дельта amoCRM: %d сделок изменено, %d удалено", changed, deleted)
+
+    async def refresh_leads(self, lead_ids: list[int]) -> None:
+        """Перекачивает указанные сделки (например, по вебхуку) вместе с контактами."""
+        client = await self._client_factory()
+        leads = await client.get_leads_by_ids(lead_ids)
+        known = self.store.existing_lead_ids(lead_ids)
+        synced = self.store.synced_status_ids()
+        leads = [l for l in leads if l["id"] in known or l.get("status_id") in synced]
+        await self._store_contacts(client, leads)
+        self.store.upsert_leads(leads)
+        self._download_done()
+
+    def _download_done(self) -> None:
+        if self._on_download_done is None:
+            return
+        try:
+            self._on_download_done()
+        except Exception:
+            logger.exception("Ошибка в on_download_done")
+
+    # ------------------------------------------------------------------
+    # Конвейер страница → контакты → телефоны
+    async def _submit(self, pending: set[asyncio.Task], coro: Coroutine) -> None:
+        """Ставит обработку страницы в окно; при заполненном окне ждёт освобождения места."""
+        pending.add(asyncio.create_task(coro))
+        while len(pending) >= self.contact_concurrency:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending -= done
+            for t in done:
+                t.result()
+
+    async def _store_page(
+        self,
+        client: AmoCRMClient,
+        leads: list[dict],
+        seen_contacts: set[int],
+        *,
+        mark_seen: bool = False,
+    ) -> None:
+        await self._store_contacts(client, leads, seen_contacts)
+        self.store.upsert_leads(leads, mark_seen=mark_seen)
+
+    async def _store_contacts(
+        self, client: AmoCRMClient, leads: list[dict], seen: set[int] | None = None
+    ) -> list[tuple[int, str, str, str | None]]:
+        """
+        Докачивает контакты сделок одним bulk-запросом и пишет телефоны в зеркало.
+        `seen` — контакты, уже обработанные в этом проходе: повторно не качаются.
+        Возвращает строки (contact_id, name, phone_raw, phone | None) в порядке сделок.
+        """
+        cids = [
+            cid
+            for cid in dict.fromkeys(
+                c["id"] for lead in leads for c in lead.get("_embedded", {}).get("contacts", [])
+            )
+            if seen is None or cid not in seen
+        ]
+        if not cids:
+            return []
+        if seen is not None:
+            seen.update(cids)
+        wanted = set(cids)
+        contacts_raw = await client.get_contacts_bulk(cids)
+        pairs = [
+            (lead, c["id"])
+            for lead in leads
+            for c in lead.get("_embedded", {}).get("contacts", [])
+            if c["id"] in wanted
+        ]
+        raws = [
+            client.extract_phone(contacts_raw.get(cid, {}).get("custom_fields_values", []))
+            for _, cid in pairs
+        ]
+        rows = []
+        for (lead, cid), phone_raw, normalized in zip(pairs, raws, client.normalize_many(raws)):
+            name = contacts_raw.get(cid, {}).get("name", "") or "Клиент"
+            rows.append((cid, name, phone_raw, normalized or None))
+            if not normalized and self._on_bad_phone:
+                self._on_bad_phone(lead, phone_raw, name)
+        self.store.upsert_contacts(rows)
+        if client.contact_cache is not None:
+            logger.debug("Кэш контактов: %s", client.contact_cache.stats())
+        return rows
+
+
+class StagePrefetcher:
+    """
+    Фоновый прогрев: раз в `interval` секунд обновляет список этапов
+    (`refresh_funnels`) и синхронизирует все этапы из `stages()`.
+    Пока админ недавно (меньше `idle_seconds` назад) сам выбирал этап,
+    прогрев откладывается, чтобы не делить с ним лимит запросов amoCRM.
+    """
+
+    def __init__(
+        self,
+        sync: StageSync,
+        refresh_funnels: Callable[[], Awaitable[object]],
+        stages: Callable[[], dict[int, list[int]]],
+        *,
+        interval: float = 300,
+        idle_seconds: float = 30,
+        tick: float = 5,
+    ) -> None:
+        """`stages()` — {pipeline_id: [status_id, …]} несистемных этапов."""
+        self.sync = sync
+        self._refresh_funnels = refresh_funnels
+        self._stages = stages
+        self.interval = interval
+        self.idle_seconds = idle_seconds
+        self.tick = tick
+        self.last_run: float | None = None  # time.time() последнего удачного прохода
+
+    async def run(self) -> None:
+        """Бесконечный цикл для asyncio.create_task()."""
+        last = None
+        while True:
+            now = time.monotonic()
+            idle = now - self.sync.last_interactive >= self.idle_seconds
+            if idle and (last is None or now - last >= self.interval):
+                await self.run_once()
+                last = time.monotonic()
+            await asyncio.sleep(self.tick)
+
+    async def run_once(self) -> None:
+        started = time.time()
+        try:
+            await self._refresh_funnels()
+            await asyncio.gather(*(
+                self.sync.sync_stages(pipeline_id, status_ids, background=True)
+                for pipeline_id, status_ids in self._stages().items()
+                if status_ids
+            ))
+        except Exception:
+            logger.exception("Фоновый прогрев этапов не удался")
+            return
+        self.last_run = time.time()
+        logger.info("Фоновый прогрев этапов: %.2f с", self.last_run - started)
@@ -0,0 +1,278 @@
+"""
+Приёмник вебхуков amoCRM: держит локальное зеркало (crm_store.CRMStore) тёплым в реальном времени.
+
+amoCRM шлёт POST `application/x-www-form-urlencoded` вида
+    leads[status][0][id]=1&leads[status][0][status_id]=2&leads[status][0][pipeline_id]=3
+    leads[update][0][id]=…      leads[add][0][id]=…      leads[delete][0][id]=…
+    contacts[update][0][id]=…&contacts[update][0][custom_fields][0][code]=PHONE&…[values][0][value]=…
+и ждёт ответ 200 не дольше пары секунд, поэтому:
+• смена этапа и удаления применяются к зеркалу сразу
+• изменённые/новые сделки собираются в пачку и докачиваются в фоне (`refresh`)
+
+Локальная проверка без amoCRM — записанные тела запросов проигрываются на приёмник:
+    python crm_webhook.py replay amocrm_contacts/webhook_samples.txt --url http://127.0.0.1:8081/amocrm/webhook
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import re
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable
+from urllib.parse import parse_qsl
+
+import aiohttp
+from aiohttp import web
+
+from amocrm_client import AmoCRMClient
+from crm_store import CRMStore
+
+logger = logging.getLogger(__name__)
+
+_KEY_PARTS = re.compile(r"[^\[\]]+")
+# Без secret приёмник слушает только эти адреса
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+def parse_form(pairs: Iterable[tuple[str, str]]) -> dict:
+    """`leads[status][0][id]=1` → {"leads": {"status": {"0": {"id": "1"}}}}."""
+    root: dict = {}
+    for key, value in pairs:
+        parts = _KEY_PARTS.findall(key)
+        if not parts:
+            continue
+        node = root
+        for part in parts[:-1]:
+            nxt = node.get(part)
+            if not isinstance(nxt, dict):
+                nxt = node[part] = {}
+            node = nxt
+        node[parts[-1]] = value
+    return root
+
+
+def _int(value, default: int = 0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _items(payload: dict, entity: str, action: str) -> list[dict]:
+    return list(payload.get(entity, {}).get(action, {}).values())
+
+
+class WebhookReceiver:
+    """aiohttp-приложение, применяющее события amoCRM к зеркалу."""
+
+    def __init__(
+        self,
+        store: CRMStore,
+        *,
+        path: str = "/amocrm/webhook",
+        secret: str | None = None,
+        refresh: Callable[[list[int]], Awaitable[None]] | None = None,
+        refresh_delay: float = 2.0,
+        record_file: Path | None = None,
+        contact_cache=None,
+    ) -> None:
+        """
+        `secret` — если задан, запрос должен содержать `?token=<secret>`.
+        `refresh(lead_ids)` — докачка сделок с контактами (StageSync.refresh_leads).
+        `record_file` — дописывать сырые тела запросов (для последующего replay).
+        `contact_cache` — crm_store.ContactCache, из которого выбрасываются изменённые контакты.
+        """
+        self.store = store
+        self.path = path
+        self.secret = secret
+        self._refresh = refresh
+        self._refresh_delay = refresh_delay
+        self._record_file = record_file
+        self._contact_cache = contact_cache
+        self._pending: set[int] = set()
+        self._flush_task: asyncio.Task | None = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        """
+        Слушает `host:port`. Без `secret` события может прислать кто угодно,
+        поэтому тогда приёмник слушает только localhost.
+        """
+        if not self.secret and host not in LOCAL_HOSTS:
+            logger.warning(
+                "Вебхуки amoCRM: secret не задан — слушаю только 127.0.0.1 вместо %s", host
+            )
+            host = "127.0.0.1"
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Вебхуки amoCRM принимаются на http://%s:%s%s", host, port, self.path)
+        return runner
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.query.get("token") != self.secret:
+            return web.Response(status=403)
+        body = await request.text()
+        if self._record_file is not None:
+            with open(self._record_file, "a", encoding="utf-8") as f:
+                f.write(body.replace("\n", "") + "\n")
+        try:
+            stats = self.apply(parse_form(parse_qsl(body, keep_blank_values=True)))
+            logger.info("Вебхук amoCRM применён: %s", stats)
+        except Exception:
+            logger.exception("Не удалось применить вебхук amoCRM")
+        return web.Response(text="ok")
+
+    # ------------------------------------------------------------------
+    def apply(self, payload: dict) -> dict:
+        """Применяет разобранное событие к зеркалу, возвращает счётчики."""
+        stats = {"moved": 0, "deleted": 0, "refresh": 0, "contacts": 0}
+
+        # Смена этапа: контакты сделки не меняются, достаточно UPDATE
+        moved = []
+        for lead in _items(payload, "leads", "status"):
+            lid = _int(lead.get("id"))
+            moved.append((
+                lid,
+                _int(lead.get("pipeline_id")),
+                _int(lead.get("status_id")),
+                _int(lead.get("updated_at") or lead.get("last_modified")),
+            ))
+        known = self.store.existing_lead_ids(m[0] for m in moved)
+        synced = self.store.synced_status_ids()
+        self.store.move_leads(m for m in moved if m[0] in known)
+        stats["moved"] = len(known)
+        # Сделка пришла в синхронизированный этап извне — нужны её контакты
+        self._schedule(m[0] for m in moved if m[0] not in known and m[2] in synced)
+
+        # Новые и изменённые сделки: могли поменяться привязанные контакты
+        changed = [
+            _int(lead.get("id"))
+            for action in ("add", "update")
+            for lead in _items(payload, "leads", action)
+        ]
+        known = self.store.existing_lead_ids(changed)
+        for action in ("add", "update"):
+            for lead in _items(payload, "leads", action):
+                lid = _int(lead.get("id"))
+                if lid in known or _int(lead.get("status_id")) in synced:
+                    self._schedule([lid])
+        stats["refresh"] = len(self._pending)
+
+        deleted = [_int(l.get("id")) for l in _items(payload, "leads", "delete")]
+        if deleted:
+            self.store.delete_leads(deleted)
+            stats["deleted"] += len(deleted)
+
+        # Контакты: телефон и имя приходят прямо в событии
+        rows = []
+        for action in ("add", "update"):
+            for co in _items(payload, "contacts", action):
+                cid = _int(co.get("id"))
+                raw = ""
+                for fld in co.get("custom_fields", {}).values():
+                    if str(fld.get("code", "")).upper() == "PHONE":
+                        raw = next(
+                            (str(v.get("value", "")).strip()
+                             for v in fld.get("values", {}).values()
+                             if str(v.get("value", "")).strip()),
+                            "",
+                        )
+                        break
+                rows.append((cid, co.get("name", "") or "Клиент", raw))
+        linked = self.store.linked_contact_ids(r[0] for r in rows)
+        kept = [r for r in rows if r[0] in linked]
+        self.store.upsert_contacts(
+            (cid, name, raw, phone or None)
+            for (cid, name, raw), phone in zip(
+                kept, AmoCRMClient.normalize_many(r[2] for r in kept)
+            )
+        )
+        stats["contacts"] = len(linked)
+        if self._contact_cache is not None:
+            self._contact_cache.invalidate(r[0] for r in rows)
+
+        removed = [_int(c.get("id")) for c in _items(payload, "contacts", "delete")]
+        if removed:
+            self.store.delete_contacts(removed)
+            if self._contact_cache is not None:
+                self._contact_cache.invalidate(removed)
+            stats["deleted"] += len(removed)
+        return stats
+
+    # ------------------------------------------------------------------
+    def _schedule(self, lead_ids: Iterable[int]) -> None:
+        """Откладывает докачку сделок, чтобы собрать пачку событий в один запрос."""
+        self._pending.update(lead_ids)
+        if self._refresh is None or not self._pending:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        # События, пришедшие во время докачки, попадают в _pending, а новая
+        # задача не создаётся (эта ещё не завершена) — поэтому крутимся, пока есть что качать
+        while self._pending:
+            await asyncio.sleep(self._refresh_delay)
+            ids, self._pending = list(self._pending), set()
+            try:
+                await self._refresh(ids)
+            except Exception:
+                logger.exception("Не удалось докачать сделки из вебхука: %s", ids)
+
+
+# ---------------------------------------------------------------------------
+# Локальная «подставка» amoCRM: проигрывает записанные тела запросов
+async def replay(samples: Path, url: str, delay: float = 0.0) -> int:
+    """POST-ит каждую непустую строку файла как тело вебхука. Возвращает число запросов."""
+    sent = 0
+    async with aiohttp.ClientSession() as session:
+        for line in samples.read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            async with session.post(
+                url, data=line, headers={"Content-Type": "application/x-www-form-urlencoded"}
+            ) as r:
+                print(f"{r.status} ← {line[:80]}")
+            sent += 1
+            if delay:
+                await asyncio.sleep(delay)
+    return sent
+
+
+def _cli() -> None:
+    ap = argparse.ArgumentParser(description="Вебхуки amoCRM: приёмник и replay")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rp = sub.add_parser("replay", help="проиграть записанные тела запросов")
+    rp.add_argument("samples", type=Path)
+    rp.add_argument("--url", default="http://127.0.0.1:8081/amocrm/webhook")
+    rp.add_argument("--delay", type=float, default=0.0)
+    sv = sub.add_parser("serve", help="поднять приёмник поверх зеркала (без докачки)")
+    sv.add_argument("--db", type=Path, default=Path(__file__).parent / "data" / "crm.sqlite3")
+    sv.add_argument("--host", default="127.0.0.1")
+    sv.add_argument("--port", type=int, default=8081)
+    sv.add_argument("--record", type=Path)
+    args = ap.parse_args()
+
+    if args.cmd == "replay":
+        asyncio.run(replay(args.samples, args.url, args.delay))
+        return
+
+    async def serve() -> None:
+        receiver = WebhookReceiver(CRMStore(args.db), record_file=args.record)
+        await receiver.start(args.host, args.port)
+        await asyncio.Event().wait()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    _cli()
@@ -0,0 +1,120 @@
+"""
+Реестр ошибочных номеров (logs/Error_numbers.csv).
+
+Номера, уже записанные в файл, держатся в памяти множеством: файл читается
+один раз при первом обращении, проверка повтора — O(1). Новые строки копятся
+в буфере и дописываются одним открытием файла в `flush()` — в конце выгрузки
+этапа, а не по строке на каждый плохой номер.
+
+Строка: lead_id, lead_name, phone, contact_name, timestamp, pipeline_id, status_id.
+Файл старого формата (первые четыре колонки) при загрузке переписывается
+с новым заголовком, у старых строк время и этап остаются пустыми.
+"""
+
+from __future__ import annotations
+
+import csv
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ["lead_id", "lead_name", "phone", "contact_name", "timestamp", "pipeline_id", "status_id"]
+PHONE_COLUMN = COLUMNS.index("phone")
+
+
+class ErrorNumberRegistry:
+    """Дедупликация и пакетная запись ошибочных номеров."""
+
+    def __init__(self, path: Path | str) -> None:
+        self.path = Path(path)
+        self._phones: set[str] | None = None
+        self._pending: list[list] = []
+
+    def _load(self) -> set[str]:
+        if self._phones is not None:
+            return self._phones
+        self._phones = set()
+        rows: list[list[str]] = []
+        header: list[str] = []
+        try:
+            if self.path.exists() and self.path.stat().st_size > 0:
+                with open(self.path, encoding="utf-8", newline="") as f:
+                    reader = csv.reader(f)
+                    header = next(reader, [])
+                    rows = list(reader)
+        except (OSError, csv.Error):
+            logger.exception("Не удалось прочитать %s", self.path)
+            return self._phones
+        for row in rows:
+            if len(row) > PHONE_COLUMN:
+                self._phones.add(row[PHONE_COLUMN])
+        if header != COLUMNS:
+            self._rewrite(rows)
+        return self._phones
+
+    def _rewrite(self, rows: list[list[str]]) -> None:
+        """Переписывает файл с текущим заголовком (миграция старого формата)."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for row in rows:
+                writer.writerow((row + [""] * len(COLUMNS))[: len(COLUMNS)])
+        os.replace(tmp, self.path)
+
+    def ensure_file(self) -> None:
+        """Создаёт файл с заголовком (или мигрирует старый)."""
+        self._load()
+        if not self.path.exists():
+            self._rewrite([])
+
+    def add(
+        self,
+        lead_id,
+        lead_name: str,
+        phone: str,
+        contact_name: str,
+        *,
+        pipeline_id: int | None = None,
+        status_id: int | None = None,
+    ) -> bool:
+        """Ставит номер в очередь на запись. False — номер уже есть в реестре."""
+        phones = self._load()
+        phone = str(phone)
+        if phone in phones:
+            return False
+        phones.add(phone)
+        self._pending.append([
+            lead_id,
+            lead_name,
+            phone,
+            contact_name,
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            pipeline_id if pipeline_id is not None else "",
+            status_id if status_id is not None else "",
+        ])
+        return True
+
+    def flush(self) -> int:
+        """Дописывает накопленные строки в файл. Возвращает их число."""
+        if not self._pending:
+            return 0
+        rows, self._pending = self._pending, []
+        try:
+            if not self.path.exists():
+                self._rewrite([])
+            with open(self.path, "a", encoding="utf-8", newline="") as f:
+                csv.writer(f).writerows(rows)
+        except OSError:
+            logger.exception("Не удалось дописать %s", self.path)
+            self._pending[:0] = rows
+            return 0
+        logger.info("Ошибочных номеров записано: %d", len(rows))
+        return len(rows)
+
+    def __contains__(self, phone: str) -> bool:
+        return str(phone) in self._load()
@@ -0,0 +1,367 @@
+"""
+Локальный «фейковый» amoCRM (Kommo API v4) для замеров и проверок без сети.
+
+Данные синтетические и детерминированные: сделки и контакты вычисляются
+по номеру на лету, поэтому сервер держит в памяти только раскладку этапов
+и спокойно отдаёт воронки на сотни тысяч сделок.
+• воронки (первая — 4524700, как TARGET_PIPELINE_ID) со своими этапами
+  и системными «Неразобранное», «Успешно реализовано» (142), «Закрыто и не реализовано» (143)
+• `/leads` — filter[statuses], filter[id], filter[responsible_user_id],
+  filter[created_at|updated_at][from|to], page/limit, 204 в конце списка;
+  у сделок есть теги и доп. поле «Город» (FIELD_CITY) для проверки фильтров в потоке
+• `/contacts` — bulk по id[i], телефон в custom_fields_values (часть номеров невалидна)
+• задержка каждого ответа и случайные 429 с Retry-After
+• `GET /_stats` — счётчики запросов, `POST /_stats/reset` — сброс
+
+Запуск:
+    python fake_amocrm.py --stages 1000,10000 --latency 0.05 --p429 0.02
+и в conf.json бота:
+    "amocrm": {"subdomain": "fake", "access_token": "fake-token",
+               "base_url": "http://127.0.0.1:8770/api/v4"}
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+from aiohttp import web
+
+FIRST_PIPELINE_ID = 4524700
+LEAD_ID_BASE = 10_000_000
+CONTACT_ID_BASE = 20_000_000
+UPDATED_AT_BASE = 1_700_000_000
+MAX_LIMIT = 250
+FIELD_CITY = 500
+CITIES = ("Москва", "Казань", "Сочи")
+RESPONSIBLE_BASE = 1000
+
+_STATUS_FILTER = re.compile(r"filter\[statuses\]\[(\d+)\]\[(pipeline_id|status_id)\]")
+
+
+@dataclass(frozen=True)
+class Stage:
+    pipeline_id: int
+    status_id: int
+    name: str
+    start: int  # номер первой сделки этапа
+    size: int
+
+    @property
+    def indices(self) -> range:
+        return range(self.start, self.start + self.size)
+
+
+class FakeAmoCRM:
+    """aiohttp-приложение, изображающее API v4 одного аккаунта."""
+
+    def __init__(
+        self,
+        stage_sizes: tuple[int, ...] = (1000,),
+        *,
+        pipelines: int = 1,
+        system_size: int = 50,
+        contact_share: float = 0.8,
+        bad_phone_every: int = 50,
+        latency: float = 0.0,
+        p429: float = 0.0,
+        retry_after: float = 1.0,
+        token: str = "fake-token",
+        seed: int = 0,
+    ) -> None:
+        """
+        `stage_sizes` — число сделок в рабочих этапах каждой воронки.
+        `system_size` — сделок в каждом системном этапе (их не должно быть в аудиториях).
+        `contact_share` — контактов на сделку: при 0.8 каждый пятый контакт
+        встречается в нескольких сделках (в том числе разных этапов).
+        `bad_phone_every` — каждый N-й контакт с невалидным номером.
+        `latency` — задержка каждого ответа, `p429` — доля ответов 429.
+        """
+        self.latency = latency
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.token = token
+        self.bad_phone_every = bad_phone_every
+        self._rng = random.Random(seed)
+        self.stats: Counter = Counter()
+
+        self.stages: list[Stage] = []
+        start = 0
+        for p in range(pipelines):
+            pid = FIRST_PIPELINE_ID + p
+            layout = [("Неразобранное", system_size)]
+            layout += [(f"Этап {k + 1}", size) for k, size in enumerate(stage_sizes)]
+            layout += [("Успешно реализовано", system_size), ("Закрыто и не реализовано", system_size)]
+            for k, (name, size) in enumerate(layout):
+                if name == "Успешно реализовано":
+                    sid = 142
+                elif name == "Закрыто и не реализовано":
+                    sid = 143
+                else:
+                    sid = 70_000_000 + p * 100 + k
+                self.stages.append(Stage(pid, sid, name, start, size))
+                start += size
+        self.total_leads = start
+        self.total_contacts = max(1, int(self.total_leads * contact_share))
+
+    # ------------------------------------------------------------------
+    # Раскладка данных
+    def work_stages(self, pipeline_id: int = FIRST_PIPELINE_ID) -> list[Stage]:
+        """Несистемные этапы воронки."""
+        return [
+            s for s in self.stages
+            if s.pipeline_id == pipeline_id and s.status_id not in (142, 143)
+            and s.name != "Неразобранное"
+        ]
+
+    def _stage_of(self, idx: int) -> Stage:
+        for s in self.stages:
+            if s.start <= idx < s.start + s.size:
+                return s
+        raise IndexError(idx)
+
+    def contact_index(self, idx: int) -> int:
+        return idx % self.total_contacts
+
+    def contact_ids(self, stage: Stage) -> list[int]:
+        """id контактов сделок этапа в порядке сделок, без повторов."""
+        return list(dict.fromkeys(CONTACT_ID_BASE + self.contact_index(i) for i in stage.indices))
+
+    def phone(self, cidx: int) -> str:
+        if self.bad_phone_every and cidx % self.bad_phone_every == 0:
+            return f"12-{cidx % 1000:03d}"
+        n = 9_160_000_000 + cidx
+        s = str(n)
+        # разные форматы записи, как у живых менеджеров
+        return (f"+7 ({s[:3]}) {s[3:6]}-{s[6:8]}-{s[8:]}", f"8{s}", f"7{s}")[cidx % 3]
+
+    def lead(self, idx: int, with_contacts: bool) -> dict:
+        s = self._stage_of(idx)
+        lead = {
+            "id": LEAD_ID_BASE + idx,
+            "name": f"Сделка #{idx}",
+            "price": 0,
+            "responsible_user_id": RESPONSIBLE_BASE + idx % 5,
+            "pipeline_id": s.pipeline_id,
+            "status_id": s.status_id,
+            "created_at": UPDATED_AT_BASE - 86_400 + idx,
+            "updated_at": UPDATED_AT_BASE + idx,
+            "custom_fields_values": [
+                {"field_id": FIELD_CITY, "field_name": "Город",
+                 "values": [{"value": CITIES[idx % len(CITIES)]}]},
+            ],
+            "_embedded": {"tags": [
+                {"id": 1, "name": name}
+                for name, every in (("VIP", 10), ("опт", 7))
+                if idx % every == 0
+            ]},
+        }
+        if with_contacts:
+            lead["_embedded"]["contacts"] = [
+                {"id": CONTACT_ID_BASE + self.contact_index(idx), "is_main": True}
+            ]
+        return lead
+
+    def contact(self, cid: int) -> dict | None:
+        cidx = cid - CONTACT_ID_BASE
+        if not 0 <= cidx < self.total_contacts:
+            return None
+        return {
+            "id": cid,
+            "name": f"Клиент {cidx}",
+            "custom_fields_values": [
+                {
+                    "field_id": 1,
+                    "field_name": "Телефон",
+                    "field_code": "PHONE",
+                    "values": [{"value": self.phone(cidx), "enum_code": "WORK"}],
+                }
+            ],
+        }
+
+    # ------------------------------------------------------------------
+    # HTTP
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        r = app.router
+        r.add_get("/api/v4/account", self.account)
+        r.add_get("/api/v4/leads/pipelines", self.pipelines)
+        r.add_get("/api/v4/leads/pipelines/{pid}/statuses", self.statuses)
+        r.add_get("/api/v4/leads", self.leads)
+        r.add_get("/api/v4/contacts", self.contacts)
+        r.add_get("/_stats", self.get_stats)
+        r.add_post("/_stats/reset", self.reset_stats)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        if request.path.startswith("/_stats"):
+            return await handler(request)
+        resource = request.match_info.route.resource
+        self.stats["requests"] += 1
+        self.stats[resource.canonical if resource else "404"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.headers.get("Authorization") != f"Bearer {self.token}":
+            self.stats["401"] += 1
+            return web.json_response({"title": "Unauthorized"}, status=401)
+        if self.p429 and self._rng.random() < self.p429:
+            self.stats["429"] += 1
+            return web.json_response(
+                {"title": "Too Many Requests"},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        return await handler(request)
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.stats.clear()
+        return web.json_response({})
+
+    async def account(self, request: web.Request) -> web.Response:
+        return web.json_response({"id": 1, "name": "Fake", "subdomain": "fake"})
+
+    async def pipelines(self, request: web.Request) -> web.Response:
+        pids = list(dict.fromkeys(s.pipeline_id for s in self.stages))
+        return web.json_response({"_embedded": {"pipelines": [
+            {"id": pid, "name": f"Воронка {pid}", "sort": k} for k, pid in enumerate(pids)
+        ]}})
+
+    async def statuses(self, request: web.Request) -> web.Response:
+        pid = int(request.match_info["pid"])
+        items = [
+            {"id": s.status_id, "name": s.name, "pipeline_id": pid, "sort": k}
+            for k, s in enumerate(x for x in self.stages if x.pipeline_id == pid)
+        ]
+        if not items:
+            return web.json_response({"title": "Not Found"}, status=404)
+        return web.json_response({"_embedded": {"statuses": items}})
+
+    def _select(self, query) -> list[range]:
+        """Диапазоны номеров сделок под фильтр в порядке updated_at."""
+        wanted: dict[str, dict[str, int]] = {}
+        for key, value in query.items():
+            m = _STATUS_FILTER.fullmatch(key)
+            if m:
+                wanted.setdefault(m.group(1), {})[m.group(2)] = int(value)
+        if wanted:
+            pairs = {(w.get("pipeline_id"), w.get("status_id")) for w in wanted.values()}
+            ranges = [s.indices for s in self.stages if (s.pipeline_id, s.status_id) in pairs]
+        else:
+            ranges = [range(self.total_leads)]
+
+        ids = [int(v) for k, v in query.items() if k.startswith("filter[id]")]
+        if ids:
+            idx = sorted({i - LEAD_ID_BASE for i in ids})
+            ranges = [range(i, i + 1) for i in idx if any(i in r for r in ranges)]
+
+        # created_at и updated_at растут вместе с номером сделки — это сужение диапазонов
+        for name, base in (("created", UPDATED_AT_BASE - 86_400), ("updated", UPDATED_AT_BASE)):
+            lo = query.get(f"filter[{name}_at][from]")
+            hi = query.get(f"filter[{name}_at][to]")
+            first = max(0, int(lo) - base) if lo is not None else 0
+            stop = max(0, int(hi) - base + 1) if hi is not None else self.total_leads
+            ranges = [range(max(r.start, first), min(r.stop, stop)) for r in ranges]
+        return [r for r in ranges if len(r)]
+
+    @staticmethod
+    def _responsible(query) -> set[int]:
+        return {int(v) for k, v in query.items() if k.startswith("filter[responsible_user_id]")}
+
+    async def leads(self, request: web.Request) -> web.Response:
+        q = request.query
+        limit = min(int(q.get("limit", 50)), MAX_LIMIT)
+        page = int(q.get("page", 1))
+        with_contacts = "contacts" in q.get("with", "")
+        skip = (page - 1) * limit
+        out: list[dict] = []
+        responsible = self._responsible(q)
+        if responsible:
+            # Не диапазонный фильтр: честно перебираем подходящие сделки
+            for r in self._select(q):
+                for idx in r:
+                    if RESPONSIBLE_BASE + idx % 5 not in responsible:
+                        continue
+                    if skip:
+                        skip -= 1
+                        continue
+                    out.append(self.lead(idx, with_contacts))
+                    if len(out) == limit:
+                        break
+                if len(out) == limit:
+                    break
+        else:
+            for r in self._select(q):
+                if skip >= len(r):
+                    skip -= len(r)
+                    continue
+                for idx in r[skip : skip + limit - len(out)]:
+                    out.append(self.lead(idx, with_contacts))
+                skip = 0
+                if len(out) == limit:
+                    break
+        if not out:
+            return web.Response(status=204)
+        return web.json_response({"_page": page, "_embedded": {"leads": out}})
+
+    async def contacts(self, request: web.Request) -> web.Response:
+        ids = [int(v) for k, v in request.query.items() if k.startswith(("id[", "filter[id]"))]
+        found = [c for c in map(self.contact, ids) if c is not None]
+        if not found:
+            return web.Response(status=204)
+        return web.json_response({"_embedded": {"contacts": found}})
+
+
+def _cli() -> None:
+    ap = argparse.ArgumentParser(description="Фейковый amoCRM API v4 с синтетическими данными")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8770)
+    ap.add_argument("--stages", default="1000", help="размеры рабочих этапов через запятую")
+    ap.add_argument("--pipelines", type=int, default=1)
+    ap.add_argument("--system-size", type=int, default=50)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    ap.add_argument("--p429", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--retry-after", type=float, default=1.0)
+    ap.add_argument("--token", default="fake-token")
+    args = ap.parse_args()
+
+    fake = FakeAmoCRM(
+        tuple(int(x) for x in args.stages.split(",") if x),
+        pipelines=args.pipelines,
+        system_size=args.system_size,
+        latency=args.latency,
+        p429=args.p429,
+        retry_after=args.retry_after,
+        token=args.token,
+    )
+
+    async def serve() -> None:
+        await fake.start(args.host, args.port)
+        print(
+            f"fake amoCRM: http://{args.host}:{args.port}/api/v4, "
+            f"сделок {fake.total_leads}, контактов {fake.total_contacts}",
+            flush=True,
+        )
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    _cli()
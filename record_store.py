@@ -0,0 +1,199 @@
+"""
+Списки записей бота (запланированные задачи, админы) в SQLite вместо JSON-файлов.
+
+Интерфейс тот же, что у JSONStore (`read`, `write`, `append`, `remove`, `update`),
+но каждая запись — отдельная строка с ключом `key(item)`:
+• вставка, удаление и изменение по ключу — одна строка, а не перезапись файла
+• каждая операция — транзакция в WAL, параллельные задачи не затирают друг друга
+• `read()` и `key in store` отдаются из кэша в памяти процесса; кэш перечитывается,
+  только если БД изменило другое соединение (`PRAGMA data_version`, не чаще
+  раза в `recheck_seconds`)
+
+При первом открытии записи переносятся из старого JSON-файла (`legacy_json`).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    store TEXT    NOT NULL,
+    key   TEXT    NOT NULL,
+    seq   INTEGER NOT NULL,
+    data  TEXT    NOT NULL,
+    PRIMARY KEY (store, key)
+);
+CREATE INDEX IF NOT EXISTS records_seq ON records (store, seq);
+CREATE TABLE IF NOT EXISTS migrated (store TEXT PRIMARY KEY);
+"""
+
+
+class SQLiteStore:
+    """Замена JSONStore: записи одного списка `name` в общей БД `path`."""
+
+    def __init__(
+        self,
+        path: Path,
+        name: str,
+        *,
+        key: Callable[[Any], Any] = lambda item: item,
+        legacy_json: Path | None = None,
+        recheck_seconds: float = 1.0,
+    ) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.name = name
+        self._key = key
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(SCHEMA)
+        self._cache: dict[str, Any] | None = None
+        self._version = -1
+        self._checked_at = 0.0
+        self.recheck_seconds = recheck_seconds
+        if legacy_json is not None:
+            self._migrate(legacy_json)
+
+    def key(self, item) -> str:
+        return str(self._key(item))
+
+    # ------------------------------------------------------------------
+    def _migrate(self, legacy_json: Path) -> None:
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            if self.db.execute("SELECT 1 FROM migrated WHERE store = ?", (self.name,)).fetchone():
+                return
+            items = []
+            try:
+                # is_file: docker создаёт каталог на месте отсутствующего bind-mount файла
+                if legacy_json.is_file() and legacy_json.read_text(encoding="utf-8").strip():
+                    items = json.loads(legacy_json.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning("Не удалось перенести %s: %s", legacy_json, e)
+            seq = self._next_seq()
+            for i, item in enumerate(items):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO records (store, key, seq, data) VALUES (?, ?, ?, ?)",
+                    (self.name, self.key(item), seq + i, json.dumps(item, ensure_ascii=False)),
+                )
+            self.db.execute("INSERT INTO migrated (store) VALUES (?)", (self.name,))
+        if items:
+            logger.info("%s: перенесено записей в %s: %d", legacy_json, self.path.name, len(items))
+
+    def _next_seq(self) -> int:
+        row = self.db.execute(
+            "SELECT COALESCE(MAX(seq), -1) + 1 FROM records WHERE store = ?", (self.name,)
+        ).fetchone()
+        return row[0]
+
+    def _items(self) -> dict[str, Any]:
+        # data_version меняется только от чужих коммитов (другой процесс, другое
+        # хранилище в этой же БД) — свои изменения кэш получает сразу
+        now = time.monotonic()
+        if self._cache is not None and now - self._checked_at < self.recheck_seconds:
+            return self._cache
+        self._checked_at = now
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if self._cache is None or version != self._version:
+            self._version = version
+            rows = self.db.execute(
+                "SELECT key, data FROM records WHERE store = ? ORDER BY seq", (self.name,)
+            )
+            self._cache = {k: json.loads(data) for k, data in rows}
+        return self._cache
+
+    # ------------------------------------------------------------------
+    # Интерфейс JSONStore
+    def read(self) -> list:
+        """Все записи в порядке добавления (копии: изменять — через update)."""
+        return json.loads(json.dumps(list(self._items().values())))
+
+    def write(self, data: list) -> None:
+        """Полная замена списка (для совместимости; точечные операции дешевле)."""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM records WHERE store = ?", (self.name,))
+            for seq, item in enumerate(data):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO records (store, key, seq, data) VALUES (?, ?, ?, ?)",
+                    (self.name, self.key(item), seq, json.dumps(item, ensure_ascii=False)),
+                )
+        self._cache = None
+
+    def append(self, item) -> None:
+        """Добавляет запись (запись с тем же ключом заменяется)."""
+        key = self.key(item)
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(
+                "INSERT OR REPLACE INTO records (store, key, seq, data) VALUES (?, ?, ?, ?)",
+                (self.name, key, self._next_seq(), json.dumps(item, ensure_ascii=False)),
+            )
+        items = self._items()
+        items.pop(key, None)
+        items[key] = json.loads(json.dumps(item))
+
+    def remove(self, predicate_func) -> int:
+        """Удаляет записи, подходящие под условие. Возвращает их число."""
+        return self.delete(*(k for k, item in self._items().items() if predicate_func(item)))
+
+    def update(self, predicate_func, **fields) -> int:
+        """Меняет поля записей, подходящих под условие. Возвращает их число."""
+        keys = [k for k, item in self._items().items() if predicate_func(item)]
+        return sum(self.update_key(k, **fields) for k in keys)
+
+    # ------------------------------------------------------------------
+    # Операции по ключу
+    def __contains__(self, key) -> bool:
+        return str(key) in self._items()
+
+    def __len__(self) -> int:
+        return len(self._items())
+
+    def get(self, key) -> Any | None:
+        item = self._items().get(str(key))
+        return json.loads(json.dumps(item)) if item is not None else None
+
+    def delete(self, *keys) -> int:
+        keys = [str(k) for k in keys]
+        if not keys:
+            return 0
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            deleted = self.db.executemany(
+                "DELETE FROM records WHERE store = ? AND key = ?", [(self.name, k) for k in keys]
+            ).rowcount
+        items = self._items()
+        for k in keys:
+            items.pop(k, None)
+        return deleted
+
+    def update_key(self, key, **fields) -> int:
+        """Меняет поля одной записи (JSON-патч в одной транзакции). 0 — записи нет."""
+        key = str(key)
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute(
+                "SELECT data FROM records WHERE store = ? AND key = ?", (self.name, key)
+            ).fetchone()
+            if row is None:
+                self._items().pop(key, None)
+                return 0
+            item = json.loads(row[0])
+            item.update(fields)
+            self.db.execute(
+                "UPDATE records SET data = ? WHERE store = ? AND key = ?",
+                (json.dumps(item, ensure_ascii=False), self.name, key),
+            )
+        self._items()[key] = item
+        return 1
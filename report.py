@@ -31,7 +31,7 @@ def generate_delivery_stats_report(
     os.makedirs(output_dir, exist_ok=True)
 
     # --- Загрузка данных ---
-    error_df = pd.read_csv(error_file)
+    error_df = pd.read_csv(error_file, dtype=str, keep_default_na=False)
     log_df = pd.read_csv(log_file)
 
     # --- Фильтрация по дате (если заданы даты) ---
@@ -41,13 +41,31 @@ def generate_delivery_stats_report(
     if date_to is not None:
         log_df = log_df[log_df["timestamp_dt"] <= date_to]
 
+    # Ошибочные номера — за тот же период; у записей старого формата
+    # нет времени, они попадают в отчёт только без ограничения дат
+    if "timestamp" in error_df.columns:
+        error_df["timestamp_dt"] = pd.to_datetime(error_df["timestamp"], errors="coerce")
+    else:
+        error_df["timestamp_dt"] = pd.NaT
+    if date_from is not None:
+        error_df = error_df[error_df["timestamp_dt"] >= date_from]
+    if date_to is not None:
+        error_df = error_df[error_df["timestamp_dt"] <= date_to]
+
     # --- Статистика ---
     sent_total = len(log_df)
     sent_success = len(log_df[log_df["status"] == "SUCCESS"])
     sent_failed = sent_total - sent_success
 
     # --- Формируем список ошибочных номеров в удобном для чтения виде ---
-    error_table = error_df[["lead_name", "phone", "contact_name"]].to_string(index=False, header=True)
+    error_columns = [
+        c for c in ("timestamp", "status_id", "lead_name", "phone", "contact_name")
+        if c in error_df.columns
+    ]
+    error_table = (
+        error_df[error_columns].fillna("").to_string(index=False, header=True)
+        if len(error_df) else "нет"
+    )
 
     # --- Формируем имя файла для отчёта ---
     date_part = ""
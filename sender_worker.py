@@ -0,0 +1,92 @@
+"""
+Отдельный поток для блокирующих отправок (PyWhatKit держит браузер и спит
+wait_time секунд на каждое сообщение).
+
+Корутины ставят отправку в asyncio-очередь и ждут её результат:
+
+    code, resp = await sender.submit(send_func, dest, message)
+
+Очередь разбирает одна задача цикла событий и передаёт отправки в единственный
+поток по одной — браузер всегда занят не больше чем одной отправкой, даже
+если рассылок несколько, а бот (aiogram) за это время продолжает отвечать.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class SenderWorker:
+    """Очередь отправок перед одним потоком-владельцем браузера."""
+
+    def __init__(self, *, maxsize: int = 100, name: str = "sender") -> None:
+        """`maxsize` — сколько отправок может ждать в очереди, дальше `submit` ждёт места."""
+        self.maxsize = maxsize
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self.completed = 0
+        self.errors = 0
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self) -> None:
+        """Запускает разбор очереди в текущем цикле событий (повторный вызов ничего не делает)."""
+        if self._task is not None and not self._task.done():
+            return
+        self._queue = asyncio.Queue(self.maxsize)
+        self._task = asyncio.create_task(self._run(), name=f"{self.name}-queue")
+
+    async def submit(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Выполняет `func(*args, **kwargs)` в потоке отправок и возвращает результат."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((future, partial(func, *args, **kwargs)))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            future, call = await self._queue.get()
+            try:
+                if future.cancelled():  # ожидавший уже ушёл — браузер не трогаем
+                    continue
+                try:
+                    result = await loop.run_in_executor(self._executor, call)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    self.errors += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.completed += 1
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    async def stop(self) -> None:
+        """Останавливает очередь; ожидающие отправки отменяются, текущая дорабатывает в потоке."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            future, _ = self._queue.get_nowait()
+            future.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        logger.info("%s: выполнено отправок %d, исключений %d", self.name, self.completed, self.errors)
@@ -0,0 +1,151 @@
+"""
+Индекс недавних доставок по logs/delivery_logs.csv: телефон → время последней
+успешной отправки. По нему из аудитории убираются номера, которым уже писали
+в течение окна (`window_hours`), — чтобы соседняя рассылка не слала их повторно.
+Заодно индекс помнит номера, последняя отправка на которые закончилась ошибкой
+(`failed_phones`), — их можно вычесть из составной аудитории.
+
+Лог только дописывается, поэтому индекс хранит смещение прочитанной части
+в контрольной точке (`state_file`) вместе с самим индексом. При старте
+и перед каждой выборкой читаются только строки после смещения. Если лог
+стал короче смещения (ротация, ручная чистка), он перечитывается целиком.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _phone_key(phone: str) -> str:
+    phone = str(phone)
+    if phone[:1] == "+" and phone[1:].isdigit():
+        return phone
+    digits = "".join(ch for ch in phone if ch.isdigit())
+    return "+" + digits if digits else ""
+
+
+class SuppressionIndex:
+    """Последние успешные доставки по телефону с инкрементальной загрузкой лога."""
+
+    def __init__(
+        self,
+        log_file: Path | str,
+        state_file: Path | str,
+        *,
+        window_hours: float = 24,
+        keep_days: float = 30,
+    ) -> None:
+        """
+        `window_hours` — сколько часов после успешной отправки номер не попадает
+        в новые аудитории (0 — не подавлять). `keep_days` — сколько хранить записи.
+        """
+        self.log_file = Path(log_file)
+        self.state_file = Path(state_file)
+        self.window_hours = window_hours
+        self.keep_days = keep_days
+        self._last: dict[str, float] = {}
+        self._failed: dict[str, float] = {}  # телефон → время последней ошибки доставки
+        self._offset = 0
+        self._load_state()
+
+    # ------------------------------------------------------------------
+    def _load_state(self) -> None:
+        try:
+            state = json.loads(self.state_file.read_text("utf-8"))
+            if "failed" not in state:
+                return  # контрольная точка без ошибок доставки — перечитываем лог
+            self._offset = int(state.get("offset", 0))
+            self._last = {p: float(ts) for p, ts in state.get("phones", {}).items()}
+            self._failed = {p: float(ts) for p, ts in state["failed"].items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError):
+            logger.warning("Контрольная точка %s повреждена, лог будет прочитан заново", self.state_file)
+            self._offset, self._last, self._failed = 0, {}, {}
+
+    def _save_state(self) -> None:
+        horizon = time.time() - max(self.keep_days * 86400, self.window_hours * 3600)
+        self._last = {p: ts for p, ts in self._last.items() if ts >= horizon}
+        self._failed = {p: ts for p, ts in self._failed.items() if ts >= horizon}
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_file.with_name(self.state_file.name + ".tmp")
+        state = {"offset": self._offset, "phones": self._last, "failed": self._failed}
+        tmp.write_text(json.dumps(state), "utf-8")
+        os.replace(tmp, self.state_file)
+
+    def refresh(self) -> int:
+        """Дочитывает новые строки лога. Возвращает число прочитанных строк."""
+        try:
+            size = self.log_file.stat().st_size
+        except FileNotFoundError:
+            return 0
+        if size < self._offset:
+            logger.info("%s стал короче контрольной точки — читаю заново", self.log_file)
+            self._offset, self._last, self._failed = 0, {}, {}
+        if size == self._offset:
+            return 0
+        with open(self.log_file, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read(size - self._offset)
+        # Последняя строка может быть дописана не до конца — её прочитаем в следующий раз
+        end = chunk.rfind(b"\n") + 1
+        if not end:
+            return 0
+        rows = 0
+        for row in csv.reader(io.StringIO(chunk[:end].decode("utf-8", errors="replace"))):
+            rows += 1
+            if len(row) < 5 or row[4] not in ("SUCCESS", "FAILED"):
+                continue  # заголовок, битые строки
+            try:
+                ts = datetime.strptime(row[0], TS_FORMAT).timestamp()
+            except ValueError:
+                continue
+            key = _phone_key(row[1])
+            if not key:
+                continue
+            if row[4] == "FAILED":
+                if ts > self._failed.get(key, 0):
+                    self._failed[key] = ts
+            elif ts > self._last.get(key, 0):
+                self._last[key] = ts
+        self._offset += end
+        self._save_state()
+        return rows
+
+    # ------------------------------------------------------------------
+    def last_success(self, phone: str) -> float | None:
+        return self._last.get(_phone_key(phone))
+
+    def failed_phones(self) -> set[str]:
+        """Телефоны, последняя отправка на которые закончилась ошибкой (за `keep_days`)."""
+        self.refresh()
+        return {p for p, ts in self._failed.items() if ts > self._last.get(p, 0)}
+
+    def recent(self, now: float | None = None) -> set[str]:
+        """Телефоны с успешной доставкой внутри окна."""
+        if self.window_hours <= 0:
+            return set()
+        since = (now or time.time()) - self.window_hours * 3600
+        return {p for p, ts in self._last.items() if ts >= since}
+
+    def filter(self, contacts: Iterable[dict]) -> tuple[list[dict], int]:
+        """Убирает из аудитории недавно получивших сообщение: (оставшиеся, сколько убрано)."""
+        contacts = list(contacts)
+        if self.window_hours <= 0:
+            return contacts, 0
+        self.refresh()
+        recent = self.recent()
+        kept = [c for c in contacts if _phone_key(c["phone"]) not in recent]
+        return kept, len(contacts) - len(kept)